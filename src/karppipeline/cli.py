@@ -1,3 +1,4 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import os
 import sys
 from typing import TYPE_CHECKING
@@ -26,11 +27,89 @@ def clean(configs: list["ConfigHandle"]) -> None:
                 shutil.rmtree(path)
 
 
+def _parse_options(argv: list[str]) -> tuple[list[str], int, bool, bool] | None:
+    """
+    Removes --jobs N (or --jobs=N), --force and --profile from the arguments, returns the other arguments, the
+    number of jobs and if --force and --profile were given, or None if an option is malformed
+    """
+    args = []
+    jobs = 1
+    force = False
+    profile = False
+    argv_iter = iter(argv)
+    for arg in argv_iter:
+        if arg == "--force":
+            force = True
+        elif arg == "--profile":
+            profile = True
+        elif arg == "--jobs" or arg.startswith("--jobs="):
+            value = arg.removeprefix("--jobs").removeprefix("=") or next(argv_iter, "")
+            if not value.isdigit() or int(value) < 1:
+                return None
+            jobs = int(value)
+        else:
+            args.append(arg)
+    return args, jobs, force, profile
+
+
+def _previous_size(config_handle: "ConfigHandle") -> int | None:
+    """
+    The number of entries in the previous run of the resource, None if it has not been run
+    """
+    from karppipeline.config import load_config
+    from karppipeline.modules import schema
+
+    try:
+        return schema.previous_size(load_config(config_handle))
+    except Exception:
+        return None
+
+
+def _process_resource(
+    config_handle: "ConfigHandle", do_run: bool, do_install: bool, kwargs: dict[str, object], silent: bool
+) -> tuple[str, str]:
+    """
+    Runs or installs one resource, with logging to the resource's log file if silent. Returns the status, success,
+    unchanged or fail, and the name of the resource for the status line.
+    """
+    import logging
+    from karppipeline.config import load_config
+    from karppipeline.install import install
+    from karppipeline.run import run
+    import karppipeline.logging as karps_logging
+
+    karps_logging.setup_resource_logging(config_handle.workdir, silent=silent)
+    try:
+        config = load_config(config_handle)
+        # run calls importers and exporters
+        if not silent:
+            if do_run:
+                task_output = "Running"
+            elif do_install:
+                task_output = "Installing"
+            else:
+                task_output = "Unknown action"
+            print(task_output, config.resource_id)
+        if do_install:
+            install(config, **kwargs)
+        elif do_run:
+            if not run(config, **kwargs):
+                return "unchanged", config.resource_id
+        return "success", config.resource_id
+    except Exception as e:
+        if isinstance(e, InstallException) or isinstance(e, ImportException):
+            logging.getLogger("karppipeline").error(f"Exception for resource: {e.args[0]}")
+        else:
+            logging.getLogger("karppipeline").error("Exception for resource", exc_info=True)
+        return "fail", str(config_handle.workdir)
+
+
 def cli():
     os.system("")
-    if len(sys.argv) > 3:
+    parsed_args = _parse_options(sys.argv)
+    if parsed_args is None or len(parsed_args[0]) > 3:
         help_text = []
-        help_text.append(f"{bold('Usage:')} karps-pipeline run/install")
+        help_text.append(f"{bold('Usage:')} karps-pipeline run/install [--jobs N] [--force] [--profile]")
         help_text.append("")
         help_text.append(f"{bold('run')} - prepares the material")
         help_text.append(f"{bold('install')} - adds the material to the requested system")
@@ -41,60 +120,71 @@ def cli():
         help_text.append("karps-pipeline install karps")
         help_text.append("karps-pipeline install sbxrepo")
         help_text.append("")
+        help_text.append(
+            f"{bold('--jobs N')} - process N resources at a time, in separate processes, starting with the largest"
+        )
+        help_text.append(
+            f"{bold('--force')} - run all modules, also those that are up to date since the last run of the resource"
+        )
+        help_text.append(
+            f"{bold('--profile')} - profile the run with cProfile, the stats are written to log/profile.prof"
+        )
+        help_text.append("")
         help_text.append(
             "Automatically picks up a config.yaml in current directory, checks for parents and children and runs the command on all resources this level and below."
         )
         print("\n".join(help_text))
         return 1
 
-    import logging
-    from karppipeline.config import find_configs, load_config
-    from karppipeline.install import install
-    from karppipeline.run import run
-    import karppipeline.logging as karps_logging
+    from karppipeline.config import find_configs
 
+    args, jobs, force, profile = parsed_args
     configs = find_configs()
 
-    if sys.argv[1] == "clean":
+    if args[1] == "clean":
         clean(configs)
         return 0
 
-    do_run = sys.argv[1] == "run"
-    do_install = sys.argv[1] == "install"
+    do_run = args[1] == "run"
+    do_install = args[1] == "install"
 
-    kwargs = {}
-    if len(sys.argv) > 2:
-        kwargs["subcommand"] = sys.argv[2]
+    kwargs: dict[str, object] = {}
+    if len(args) > 2:
+        kwargs["subcommand"] = args[2]
+    if do_run:
+        kwargs["force"] = force
+        kwargs["profile"] = profile
 
     silent = False
     if len(configs) > 1:
         silent = True
-    for config_handle in configs:
-        karps_logging.setup_resource_logging(config_handle.workdir, silent=silent)
-        try:
-            config = load_config(config_handle)
-            # run calls importers and exporters
-            if not silent:
-                if do_run:
-                    task_output = "Running"
-                elif do_install:
-                    task_output = "Installing"
-                else:
-                    task_output = "Unknown action"
-                print(task_output, config.resource_id)
-            if do_install:
-                install(config, **kwargs)
-            elif do_run:
-                run(config, **kwargs)
-            if silent:
-                # TODO inform user if there was warnings
-                print(f"{green_box()} {config.resource_id}\t success")
-        except Exception as e:
-            if isinstance(e, InstallException) or isinstance(e, ImportException):
-                logging.getLogger("karppipeline").error(f"Exception for resource: {e.args[0]}")
+
+    def print_status(status: str, name: str) -> None:
+        if silent:
+            # TODO inform user if there was warnings
+            if status == "fail":
+                print(f"{red_box()} {name}\t fail")
             else:
-                logging.getLogger("karppipeline").error("Exception for resource", exc_info=True)
-            if silent:
-                print(f"{red_box()} {config_handle.workdir}\t fail")
+                print(f"{green_box()} {name}\t {status}")
+
+    if jobs == 1 or len(configs) == 1:
+        for config_handle in configs:
+            print_status(*_process_resource(config_handle, do_run, do_install, kwargs, silent))
+        return 0
+
+    # the largest resources are started first, so that the run doesn't end waiting for one of them. Resources that
+    # have not been run before are started before all others, since their size is unknown
+    def largest_first(config_handle: "ConfigHandle") -> int:
+        size = _previous_size(config_handle)
+        return -sys.maxsize if size is None else -size
+
+    configs.sort(key=largest_first)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(_process_resource, config_handle, do_run, do_install, kwargs, silent)
+            for config_handle in configs
+        ]
+        for future in as_completed(futures):
+            print_status(*future.result())
 
     return 0
@@ -1,4 +1,6 @@
+from contextlib import suppress
 from pathlib import Path
+from typing import Generator
 
 type Map = dict[str, object]
 
@@ -11,6 +13,37 @@ class ImportException(Exception):
     pass
 
 
+class GeneratorTask:
+    """
+    Entry task that sends each entry to a generator, for example one that writes the entries to a file.
+
+    close() is called by run when all entries have been processed, the generator is then sent None, which
+    lets it finish its work. If the run fails, the generator is instead closed when garbage collected.
+
+    The generator must not modify the entries, it is a sink that run gives a thread of its own.
+    """
+
+    sink = True
+
+    def __init__(self, gen: Generator[None, object, None]):
+        self._gen = gen
+        next(gen)
+
+    def __call__(self, entry, /):
+        self._gen.send(entry)
+        return entry
+
+    def batch(self, entries, /):
+        send = self._gen.send
+        for entry in entries:
+            send(entry)
+        return entries
+
+    def close(self) -> None:
+        with suppress(StopIteration):
+            self._gen.send(None)
+
+
 def create_output_dir(path: Path) -> Path:
     return _create_dir(path / "output")
 
@@ -0,0 +1,44 @@
+"""
+Converters are used in export.fields, for example "pos:ud.saldo_to_ud as upos". A converter is a function in a module
+in this package that is called with the resource id and the value of the field (or the whole entry for "*"). Each
+converter has a companion function, <name>_update_schema, that updates the field in the entry schema.
+
+A converter may also have a <name>_batch function, that is called with the resource id and a list of values and
+returns a list of the converted values. It is used when entries are converted in batches, unless the converter is
+pure and its results are cached.
+"""
+
+import functools
+from typing import Callable
+
+
+def pure(converter: Callable) -> Callable:
+    """
+    Marks a converter as pure, i.e. the result only depends on the value (and the resource id) and is not modified
+    afterwards. The results of pure converters are cached by the pipeline.
+    """
+    converter.pure = True
+    return converter
+
+
+def is_pure(converter: Callable) -> bool:
+    return getattr(converter, "pure", False)
+
+
+def memoize(converter: Callable, resource_id: str, maxsize: int) -> Callable[[object], object]:
+    """
+    Wraps a pure converter in a LRU cache of at most maxsize values. The cache is keyed on the value and its type (1,
+    1.0 and True are cached separately), not on the resource id since it is the same for the whole run. Lists and
+    dicts can't be cached and are converted every time.
+
+    The returned function only takes the value, use cache_info() on it for hits and misses.
+    """
+    cached = functools.lru_cache(maxsize=maxsize, typed=True)(functools.partial(converter, resource_id))
+
+    def convert(value):
+        if value.__class__ is list or value.__class__ is dict:
+            return converter(resource_id, value)
+        return cached(value)
+
+    convert.cache_info = cached.cache_info
+    return convert
@@ -2,6 +2,7 @@
 A lot of this is copied from Sparv and modified
 """
 
+from karppipeline.converters import pure
 from karppipeline.models import InferredField
 
 
@@ -18,25 +19,35 @@ def saldo_to_ud_update_schema(field: InferredField) -> InferredField:
     return field
 
 
+@pure
 def saldo_to_ud(_, pos: str) -> str:
-    # TODO memoize
     return suc_to_ud(None, saldo_to_suc(None, pos))
 
 
+def saldo_to_ud_batch(_, pos_values: list[str]) -> list[str]:
+    return suc_to_ud_batch(None, saldo_to_suc_batch(None, pos_values))
+
+
 def saldo_to_suc_update_schema(field: InferredField) -> InferredField:
     field.extra["length"] = 2
     return field
 
 
+@pure
 def saldo_to_suc(_, pos: str) -> str:
     return _saldo_pos_to_suc[pos]
 
 
+def saldo_to_suc_batch(_, pos_values: list[str]) -> list[str]:
+    return [_saldo_pos_to_suc[pos] for pos in pos_values]
+
+
 def suc_to_ud_update_schema(field: InferredField) -> InferredField:
     field.extra["length"] = 5
     return field
 
 
+@pure
 def suc_to_ud(_, pos: str) -> str:
     """
     Convert SUC tags to UPOS.
@@ -47,34 +58,12 @@ def suc_to_ud(_, pos: str) -> str:
     Returns:
         UPOS tag.
     """
-    pos_dict = {
-        "NN": "NOUN",
-        "PM": "PROPN",
-        "VB": "VERB",  # "AUX" ?
-        "IE": "PART",
-        "PC": "VERB",  # No ADJ?
-        "PL": "PART",  # No ADV, ADP?
-        "PN": "PRON",
-        "PS": "DET",  # No PRON?
-        "HP": "PRON",
-        "HS": "DET",  # No PRON?
-        "DT": "DET",
-        "HD": "DET",
-        "JJ": "ADJ",
-        "AB": "ADV",
-        "HA": "ADV",
-        "KN": "CONJ",
-        "SN": "SCONJ",
-        "PP": "ADP",
-        "RG": "NUM",
-        "RO": "ADJ",  # ordinal numerals are adjectives
-        "IN": "INTJ",
-        "UO": "X",
-        "MAD": "PUNCT",
-        "MID": "PUNCT",
-        "PAD": "PUNCT",
-    }
-    return pos_dict.get(pos.upper(), UD_FALLBACK)
+    return _suc_to_ud.get(pos.upper(), UD_FALLBACK)
+
+
+def suc_to_ud_batch(_, pos_values: list[str]) -> list[str]:
+    get = _suc_to_ud.get
+    return [get(pos.upper(), UD_FALLBACK) for pos in pos_values]
 
 
 def isof_to_ud_update_schema(field: InferredField) -> InferredField:
@@ -82,6 +71,7 @@ def isof_to_ud_update_schema(field: InferredField) -> InferredField:
     return field
 
 
+@pure
 def isof_to_ud(_, pos: str) -> str:
     """
     Convert isofs internal markup for POS into ud (experimental)
@@ -89,11 +79,17 @@ def isof_to_ud(_, pos: str) -> str:
     return _isof_nyord_to_ud.get(pos, UD_FALLBACK)
 
 
+def isof_to_ud_batch(_, pos_values: list[str]) -> list[str]:
+    get = _isof_nyord_to_ud.get
+    return [get(pos, UD_FALLBACK) for pos in pos_values]
+
+
 def sveak_to_ud_update_schema(field: InferredField) -> InferredField:
     field.extra["length"] = 5
     return field
 
 
+@pure
 def sveak_to_ud(_, pos: str) -> str:
     """
     Convert internal/legacy SveAk POS to ud
@@ -148,6 +144,34 @@ _saldo_pos_to_suc = {
     "pma": "PM",
 }
 
+_suc_to_ud = {
+    "NN": "NOUN",
+    "PM": "PROPN",
+    "VB": "VERB",  # "AUX" ?
+    "IE": "PART",
+    "PC": "VERB",  # No ADJ?
+    "PL": "PART",  # No ADV, ADP?
+    "PN": "PRON",
+    "PS": "DET",  # No PRON?
+    "HP": "PRON",
+    "HS": "DET",  # No PRON?
+    "DT": "DET",
+    "HD": "DET",
+    "JJ": "ADJ",
+    "AB": "ADV",
+    "HA": "ADV",
+    "KN": "CONJ",
+    "SN": "SCONJ",
+    "PP": "ADP",
+    "RG": "NUM",
+    "RO": "ADJ",  # ordinal numerals are adjectives
+    "IN": "INTJ",
+    "UO": "X",
+    "MAD": "PUNCT",
+    "MID": "PUNCT",
+    "PAD": "PUNCT",
+}
+
 _isof_nyord_to_ud = {
     # combined words (klimatbanta, klimatbantare) get X - unknown
     "substantiv": "NOUN",
@@ -0,0 +1,64 @@
+"""
+Fingerprints of the inputs of the modules: the source files, the merged config (without the settings of other
+modules), the pipeline version, the fingerprints of the module's dependencies and, for modules that read from
+elsewhere, the module's external_inputs(config). external_inputs must not fetch anything, it returns None when the
+inputs are not known without fetching them, and then the module always runs. The fingerprints are saved after
+each run, and run skips the modules whose fingerprints have not changed since.
+"""
+
+import hashlib
+import importlib.metadata
+from pathlib import Path
+
+from karppipeline.common import create_output_dir, get_output_dir
+from karppipeline.models import PipelineConfig
+from karppipeline.util import json
+
+
+def get_inputs(config: PipelineConfig) -> dict[str, object]:
+    """
+    The inputs of all the modules of the resource, see fingerprint
+    """
+    try:
+        version = importlib.metadata.version("karp-pipeline")
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    # the files are not read, a changed file is assumed to have a new size or modification time
+    sources = [
+        (str(path), stat.st_size, stat.st_mtime_ns)
+        for path in sorted(config.workdir.glob("source/*"))
+        for stat in [path.stat()]
+    ]
+    return {
+        "version": version,
+        "config": config.model_dump(mode="json"),
+        "sources": sources,
+        "modules": list(config.modules),
+    }
+
+
+def fingerprint(
+    inputs: dict[str, object], cmd: str, dependency_fingerprints: list[str], external_inputs: object = None
+) -> str:
+    modules = inputs["modules"]
+    # the settings of the other modules are left out, these only matter if they are dependencies
+    config = {key: value for key, value in inputs["config"].items() if key not in modules or key == cmd}
+    key = [inputs["version"], inputs["sources"], config, cmd, dependency_fingerprints, external_inputs]
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+def load(config: PipelineConfig) -> dict[str, str]:
+    path = _get_fingerprints_path(config)
+    if not path.exists():
+        return {}
+    return json.loads(path.read_bytes())
+
+
+def save(config: PipelineConfig, fingerprints: dict[str, str]) -> None:
+    create_output_dir(config.workdir)
+    with open(_get_fingerprints_path(config), "w") as fp:
+        fp.write(json.dumps(fingerprints))
+
+
+def _get_fingerprints_path(config: PipelineConfig) -> Path:
+    return get_output_dir(config.workdir) / "fingerprints.json"
@@ -1,34 +1,57 @@
 import logging
-from karppipeline.models import Entry, PipelineConfig
+from pathlib import Path
 
-from karppipeline.common import create_output_dir
-from karppipeline.util import json
+import orjson
 
-__all__ = ["export", "dependencies"]
+from karppipeline.models import PipelineConfig
+from karppipeline.common import GeneratorTask, create_output_dir, get_output_dir
+from karppipeline.modules.jsonl.models import JsonlConfig
+from karppipeline.util import compression, json
+
+__all__ = ["export", "dependencies", "get_output_path"]
 logger = logging.getLogger(__name__)
 
 dependencies = ["schema"]
 
+# the number of bytes collected before they are written to the file
+BUFFER_SIZE = 1024 * 1024
+
 
 def export(config: PipelineConfig, _):
     """
     Writes each entry to file
     """
+    create_output_dir(config.workdir)
+    path = get_output_path(config)
+    # remove the output of earlier runs with other compression settings, so that installers don't find it
+    for suffix in ("", ".gz", ".zst"):
+        other_path = get_output_dir(config.workdir) / f"{config.resource_id}.jsonl{suffix}"
+        if other_path != path:
+            other_path.unlink(missing_ok=True)
 
     def json_dump():
-        with open(create_output_dir(config.workdir) / f"{config.resource_id}.jsonl", "w") as fp:
+        dumps = orjson.dumps
+        option = orjson.OPT_APPEND_NEWLINE
+        default = json.custom_serializer
+        buffer = bytearray()
+        with compression.open_write(path) as fp:
             while True:
                 entry = yield
-                if not entry:
+                if entry is None:
                     break
-                fp.write(json.dumps(entry) + "\n")
+                buffer += dumps(entry, default=default, option=option)
+                if len(buffer) >= BUFFER_SIZE:
+                    fp.write(buffer)
+                    buffer.clear()
+            fp.write(buffer)
 
-    gen = json_dump()
-    next(gen)
+    return (GeneratorTask(json_dump()),)
 
-    def task(entry: Entry, /) -> Entry:
-        logger.debug("jsonl entry task")
-        gen.send(entry)
-        return entry
 
-    return (task,)
+def get_output_path(config: PipelineConfig) -> Path:
+    """
+    The JSONL file written by export, compressed if jsonl.compression is set
+    """
+    module_config = JsonlConfig.model_validate(config.modules.get("jsonl", {}))
+    suffix = f".{module_config.compression}" if module_config.compression else ""
+    return get_output_dir(config.workdir) / f"{config.resource_id}.jsonl{suffix}"
@@ -0,0 +1,8 @@
+from typing import Literal
+
+from pydantic import BaseModel
+
+
+class JsonlConfig(BaseModel):
+    # compress the output, gives <resource_id>.jsonl.gz or <resource_id>.jsonl.zst (requires karp-pipeline[zstd])
+    compression: Literal["gz", "zst"] | None = None
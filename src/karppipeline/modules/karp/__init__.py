@@ -1,18 +1,25 @@
+from contextlib import contextmanager
 import logging
+from pathlib import Path
+import shutil
 import subprocess
-from typing import Callable, cast
+import tempfile
+from typing import Callable, Iterator, cast
 from karppipeline.common import ImportException, create_output_dir, get_output_dir
 from karppipeline.models import Entry, EntrySchema, PipelineConfig
-from karppipeline.util import yaml
+from karppipeline.modules import jsonl
+from karppipeline.util import compression, yaml
 
 logger = logging.getLogger("karp")
 
 # generate Karp backend configuration and SQL, could be broken up into two tasks
 
 
-__all__ = ["export", "install", "dependencies"]
+__all__ = ["export", "install", "dependencies", "has_entry_tasks"]
 
 dependencies = ["jsonl", "sbxmetadata"]
+# karp uses the output file of jsonl, it has no entry tasks
+has_entry_tasks = False
 
 
 def export(config: PipelineConfig, module_data) -> list[Callable[[Entry], Entry]]:
@@ -46,12 +53,27 @@ def install(config: PipelineConfig):
     karps_config = cast(dict, config.modules["karp"])
     _karp_cli_runner(karps_config, ["resource", "create", str(config_file)])
     # adding entries
-    data_file = get_output_dir(config.workdir) / f"{config.resource_id}.jsonl"
-    _karp_cli_runner(karps_config, ["entries", "add", config.resource_id, str(data_file)])
+    with _uncompressed(jsonl.get_output_path(config)) as data_file:
+        _karp_cli_runner(karps_config, ["entries", "add", config.resource_id, str(data_file)])
     # publish the resource
     _karp_cli_runner(karps_config, ["resource", "publish", config.resource_id])
 
 
+@contextmanager
+def _uncompressed(data_file: Path) -> Iterator[Path]:
+    """
+    Gives the data file uncompressed, a compressed file is decompressed to a temporary file
+    """
+    if not compression.is_compressed(data_file):
+        yield data_file
+        return
+    with tempfile.NamedTemporaryFile(dir=data_file.parent, suffix=".jsonl") as tmp:
+        with compression.open_read(data_file) as fp:
+            shutil.copyfileobj(fp, tmp, compression.CHUNK_SIZE)
+        tmp.flush()
+        yield Path(tmp.name)
+
+
 def _karp_cli_runner(config: dict[str, str], cmds):
     karp_cli = config["cli"]
     cwd = config["cwd"]
@@ -1,7 +1,7 @@
 import logging
 from typing import Callable
 
-from karppipeline.common import ImportException, create_output_dir
+from karppipeline.common import GeneratorTask, ImportException, create_output_dir
 import karppipeline.modules.karps.install as backend_install
 from karppipeline.modules.karps.models import KarpsConfig
 from karppipeline.models import ConfiguredField, Entry, EntrySchema, InferredField, PipelineConfig
@@ -41,14 +41,7 @@ def export(
         raise ImportException("karps: 'name' missing")
     backend_export.create_karps_backend_config(config, module_config, name, entry_schema, source_order, size, fields)
 
-    next(sql_gen)
-
-    def task(entry: Entry) -> Entry:
-        logger.debug("karps entry task")
-        sql_gen.send(entry)
-        return entry
-
-    return [task]
+    return [GeneratorTask(sql_gen)]
 
 
 def install(pipeline_config: PipelineConfig):
@@ -59,6 +52,7 @@ def install(pipeline_config: PipelineConfig):
     karps_config = _get_module_config(pipeline_config)
 
     backend_install.add_to_db(pipeline_config, karps_config)
+    backend_install.update_installed_manifest(pipeline_config)
     backend_install.add_config(pipeline_config, karps_config, pipeline_config.resource_id)
 
 
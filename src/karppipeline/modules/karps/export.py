@@ -1,13 +1,23 @@
+from contextlib import ExitStack
+import logging
+from pathlib import Path
+import shutil
 import time
 from typing import Generator, Iterable, Iterator, Mapping
 
 
-from karppipeline.common import create_output_dir, get_output_dir
+from karppipeline.common import ImportException, create_output_dir, get_output_dir
+from karppipeline.modules.karps import manifest
 from karppipeline.modules.karps.models import KarpsConfig
 from karppipeline.models import Entry, EntrySchema, PipelineConfig, InferredField
-from karppipeline.util import yaml
+from karppipeline.util import json, yaml
+
+logger = logging.getLogger(__name__)
 
 VARCHAR_CUTOFF = 200  # if a field contains values larger than this, use TEXT type and skip indexing
+MAX_TABLE_NAME_LENGTH = 64  # the max length of table names in MariaDB
+# the suffixes of the new tables of a full export, alternating between exports
+GENERATION_SUFFIXES = ("$a", "$b")
 
 
 def create_karps_backend_config(
@@ -87,31 +97,20 @@ def create_karps_backend_config(
 def create_karps_sql(
     pipeline_config: PipelineConfig, karps_config: KarpsConfig, resource_config: EntrySchema
 ) -> Generator[None, Entry | None, None]:
-    def schema(table_name: str, structure: EntrySchema) -> tuple[str, str]:
+    def schema(table_name: str, structure: EntrySchema, suffix: str = "") -> tuple[str, str]:
         """
         Find schema automatically by going through all elements
-        """
 
-        def delete_statement(table_name) -> str:
-            """
-            Each resource with collections produces multiple tables, prefixed with {resource_id}__ and these statements
-            removed them dynamically
-            """
-            return f"""
-            SELECT CONCAT('DROP TABLE IF EXISTS `', GROUP_CONCAT(TABLE_NAME SEPARATOR '`, `'), '`;')
-            INTO @drop_stmt FROM information_schema.TABLES 
-            WHERE TABLE_SCHEMA = '{karps_config.db_database}' AND TABLE_NAME LIKE '{table_name}__%';
-            SET @run_stmt = IF(@drop_stmt IS NOT NULL, @drop_stmt, 'SELECT "No tables to drop";');
-            PREPARE stmt FROM @run_stmt;
-            EXECUTE stmt;
-            DEALLOCATE PREPARE stmt;
-            DROP TABLE IF EXISTS `{table_name}`;
-            """
+        Returns the SQL for creating the tables and the SQL for creating the indexes, which should be run after the
+        data is loaded. The indexes of a table are added with one ALTER TABLE, so that the table is only read once.
+
+        The tables are created with suffix added to their names, the index names are the same for all suffixes.
+        """
 
         def inner(_structure: Iterable[InferredField]):
             tables = []
             fields = []
-            indices = []
+            indices: dict[str, list[str]] = {}
             for field in _structure:
                 field_name = field.name
                 if field.collection:
@@ -127,10 +126,10 @@ def create_karps_sql(
                     _, inner_fields, _ = inner(table_fields)
                     inner_table_name = f"{table_name}__{field_name}"
                     tables.append(f"""
-                    CREATE TABLE `{inner_table_name}` (
+                    CREATE TABLE `{inner_table_name}{suffix}` (
                         {",\n".join(inner_fields)},
                         __parent_id INT,
-                        FOREIGN KEY (__parent_id) REFERENCES `{table_name}`(__id)
+                        FOREIGN KEY (__parent_id) REFERENCES `{table_name}{suffix}`(__id)
                     )
                     CHARACTER SET {karps_config.db_charset}
                     COLLATE {karps_config.db_collation};
@@ -138,8 +137,9 @@ def create_karps_sql(
 
                     for col_name, inner_field in columns.items():
                         if inner_field.type == "text" and inner_field.length <= VARCHAR_CUTOFF:
-                            indices.append(
-                                f"CREATE INDEX `{inner_table_name}_{col_name}_idx` ON `{inner_table_name}`(`{col_name}`({inner_field.extra['length']}));"
+                            length = inner_field.extra["length"]
+                            indices.setdefault(inner_table_name, []).append(
+                                f"ADD INDEX `{inner_table_name}_{col_name}_idx`(`{col_name}`({length}))"
                             )
                 else:
                     if field.type == "integer":
@@ -149,8 +149,8 @@ def create_karps_sql(
                             column_type = "TEXT"
                         else:
                             column_type = f"VARCHAR({field.extra['length']})"
-                            indices.append(
-                                f"CREATE INDEX `{table_name}__{field_name}_idx` ON `{table_name}`(`{field_name}`({field.extra['length']}));"
+                            indices.setdefault(table_name, []).append(
+                                f"ADD INDEX `{table_name}__{field_name}_idx`(`{field_name}`({field.extra['length']}))"
                             )
                     elif field.type == "float":
                         column_type = "FLOAT"
@@ -163,8 +163,7 @@ def create_karps_sql(
 
         return (
             f"""
-        {delete_statement(table_name)}
-        CREATE TABLE `{table_name}` (
+        CREATE TABLE `{table_name}{suffix}` (
             __id INT PRIMARY KEY,
             {",\n".join(fields)}
         )
@@ -172,77 +171,262 @@ def create_karps_sql(
         COLLATE {karps_config.db_collation};
         """
             + "".join(tables)
-        ), "\n".join(indices) + "\n"
+        ), "".join(
+            f"ALTER TABLE `{table}{suffix}` {', '.join(table_indices)};\n" for table, table_indices in indices.items()
+        )
 
-    def entries_sql() -> Generator[list[str], Entry | None, None]:
-        idx = 0
-        lines = []
-        while True:
-            entry = yield lines
-            if entry is None:
-                break
+    resource_id = pipeline_config.resource_id
 
-            def format_str(val):
-                """
-                Wrap string in single quotes, escape backslashes and single quotes
-                """
-                return f"'{val.replace('\\', '\\\\').replace("'", "\\'").replace('\n', '\\n')}'"
-
-            def format_value(val):
-                if val is None:
-                    return "NULL"
-                elif isinstance(val, str):
-                    return format_str(val)
-                elif isinstance(val, int) or isinstance(val, float):
-                    return str(val)
-                elif isinstance(val, dict):
-                    return ",".join([format_value(v) for v in val.values()])
-                else:
-                    raise Exception("unknown type")
-
-            def sqlify_values(entry):
-                """
-                if values are scalar, they must be formatted/encoded in a wway that makes sense for MySQL
-                if values are lists, they must be transformed into a separate INSERT statement with a ref to parent (idx from closure)
-                """
-                inserts = []
-                columns = []
-                main_values = []
-                for field_name, val in entry.items():
-                    if isinstance(val, list):
-                        for x in val:
-                            if isinstance(x, dict):
-                                keys = x.keys()
-                            else:
-                                keys = [field_name]
-                            inserts.append(
-                                f"INSERT INTO `{pipeline_config.resource_id}__{field_name}` (__parent_id, {','.join(f'`{key}`' for key in keys)}) VALUES ({idx}, {format_value(x)});\n"
-                            )
-                    elif val is not None:
-                        columns.append(field_name)
-                        main_values.append(format_value(val))
-                return inserts, columns, main_values
-
-            inserts, columns, values = sqlify_values(entry)
-
-            # main entry
-            lines = [
-                f"INSERT INTO `{pipeline_config.resource_id}` (`__id`, {', '.join(f'`{column}`' for column in columns)}) VALUES ({idx}, {', '.join(values)});\n"
-            ] + inserts
-
-            idx += 1
-
-    sql_gen = entries_sql()
-    next(sql_gen)
-    with open(get_output_dir(pipeline_config.workdir) / f"{pipeline_config.resource_id}.sql", "w") as fp:
-        schema_sql, indices = schema(pipeline_config.resource_id, resource_config)
-        fp.write(schema_sql)
-        fp.write(indices)
+    def format_str(val):
+        """
+        Wrap string in single quotes, escape backslashes and single quotes
+        """
+        return f"'{val.replace('\\', '\\\\').replace("'", "\\'").replace('\n', '\\n')}'"
+
+    def format_value(val):
+        if val is None:
+            return "NULL"
+        elif isinstance(val, str):
+            return format_str(val)
+        elif isinstance(val, int) or isinstance(val, float):
+            return str(val)
+        else:
+            raise Exception("unknown type")
+
+    # the columns of each table, all rows are given values for all columns so that rows can be grouped into
+    # multi-row INSERT statements
+    main_columns = [name for name, field in resource_config.items() if not field.collection]
+    child_columns = {
+        name: list(field.fields) if field.type == "table" else [name]
+        for name, field in resource_config.items()
+        if field.collection
+    }
+    table_columns = {resource_id: ["__id", *main_columns]} | {
+        f"{resource_id}__{name}": ["__parent_id", *columns] for name, columns in child_columns.items()
+    }
+    # the tables for collection fields, their rows are replaced when an entry is updated
+    child_tables = [f"{resource_id}__{name}" for name in child_columns]
+
+    def row_values(idx: int, columns: list[str], values: Mapping[str, object]) -> list[object]:
+        return [idx, *(values.get(column) for column in columns)]
+
+    def insert_rows(idx: int, entry: Entry) -> Iterator[tuple[str, list[object]]]:
+        """
+        Gives the table and the values of each row to insert for the entry. Values in collection fields are
+        inserted in separate tables with a ref to parent (idx)
+        """
+        yield resource_id, row_values(idx, main_columns, entry)
+        for field_name, columns in child_columns.items():
+            for x in entry.get(field_name) or ():
+                yield (
+                    f"{resource_id}__{field_name}",
+                    row_values(idx, columns, x if isinstance(x, dict) else {field_name: x}),
+                )
+
+    insert_batch_size = karps_config.insert_batch_size
+    insert_max_bytes = karps_config.insert_max_bytes
+
+    def write_rows(table: str) -> None:
+        if pending_rows[table]:
+            fp.write(insert_prefixes[table] + ", ".join(pending_rows[table]) + ";\n")
+            pending_rows[table] = []
+            pending_bytes[table] = len(insert_prefixes[table])
+
+    def write_all_rows() -> None:
+        # the main table is written first, so that rows in the child tables can refer to it
+        for table in pending_rows:
+            write_rows(table)
+
+    def add_row(table: str, values: list[object]) -> None:
+        row = f"({', '.join(format_value(value) for value in values)})"
+        row_bytes = (len(row) if row.isascii() else len(row.encode())) + 2
+        rows = pending_rows[table]
+        if rows and (len(rows) >= insert_batch_size or pending_bytes[table] + row_bytes > insert_max_bytes):
+            if table != resource_id:
+                write_rows(resource_id)
+            write_rows(table)
+        pending_rows[table].append(row)
+        pending_bytes[table] += row_bytes
+
+    def add_data_row(table: str, values: list[object]) -> None:
+        data_files[table].write("\t".join(_format_data_value(value) for value in values) + "\n")
+
+    def delete_children_sql(idx: int) -> list[str]:
+        return [f"DELETE FROM `{table}` WHERE __parent_id = {idx};\n" for table in child_tables]
+
+    def update_sql(idx: int, entry: Entry) -> list[str]:
+        assignments = ", ".join(f"`{column}` = {format_value(entry.get(column))}" for column in main_columns)
+        return delete_children_sql(idx) + [f"UPDATE `{resource_id}` SET {assignments} WHERE __id = {idx};\n"]
+
+    def delete_sql(idx: int) -> list[str]:
+        return delete_children_sql(idx) + [f"DELETE FROM `{resource_id}` WHERE __id = {idx};\n"]
+
+    key = karps_config.key
+    if karps_config.incremental and not key:
+        raise ImportException("karps: incremental requires key")
+    new_manifest = manifest.Manifest(schema_hash=manifest.hash_schema(schema(resource_id, resource_config)[0]))
+    previous_manifest = None
+    if karps_config.incremental:
+        previous_manifest = manifest.load(manifest.get_installed_manifest_path(pipeline_config))
+        if previous_manifest and previous_manifest.schema_hash != new_manifest.schema_hash:
+            logger.info("karps: the schema has changed since the last install, creating SQL for all entries")
+            previous_manifest = None
+    next_id = previous_manifest.next_id if previous_manifest else 0
+
+    # a full export creates a new generation of the tables, with a suffix so that the tables in use are untouched
+    # until install swaps in the new tables. Changes are made to the tables in use.
+    suffix = ""
+    if not previous_manifest:
+        generation_path = get_generation_path(pipeline_config)
+        previous_suffix = json.loads(generation_path.read_bytes())["suffix"] if generation_path.exists() else None
+        suffix = GENERATION_SUFFIXES[1] if previous_suffix == GENERATION_SUFFIXES[0] else GENERATION_SUFFIXES[0]
+    schema_sql, indices = schema(resource_id, resource_config, suffix)
+    for table in table_columns:
+        if len(table + suffix) > MAX_TABLE_NAME_LENGTH:
+            raise ImportException(
+                f"karps: the table name {table}{suffix} is {len(table + suffix)} characters,"
+                f" the max is {MAX_TABLE_NAME_LENGTH}"
+            )
+    if previous_manifest:
+        get_generation_path(pipeline_config).unlink(missing_ok=True)
+    else:
+        with open(get_generation_path(pipeline_config), "w") as generation_fp:
+            generation_fp.write(json.dumps({"suffix": suffix, "tables": list(table_columns)}))
+
+    insert_prefixes = {
+        table: f"INSERT INTO `{table}{suffix}` ({', '.join(f'`{column}`' for column in columns)}) VALUES "
+        for table, columns in table_columns.items()
+    }
+    # rows waiting to be written, one multi-row INSERT per table
+    pending_rows: dict[str, list[str]] = {table: [] for table in table_columns}
+    pending_bytes = {table: len(prefix) for table, prefix in insert_prefixes.items()}
+
+    # a full export can be written as data files to bulk load, changes are always written as SQL statements
+    bulk_load = karps_config.bulk_load and not previous_manifest
+    # remove the files of the other format, install uses the files that exist
+    data_dir = get_data_dir(pipeline_config)
+    shutil.rmtree(data_dir, ignore_errors=True)
+    if bulk_load:
+        get_sql_path(pipeline_config).unlink(missing_ok=True)
+        data_dir.mkdir()
+        sql_path = get_schema_sql_path(pipeline_config)
+        insert_row = add_data_row
+    else:
+        get_schema_sql_path(pipeline_config).unlink(missing_ok=True)
+        get_index_sql_path(pipeline_config).unlink(missing_ok=True)
+        sql_path = get_sql_path(pipeline_config)
+        insert_row = add_row
+
+    with ExitStack() as stack:
+        fp = stack.enter_context(open(sql_path, "w"))
+        data_files = {}
+        if bulk_load:
+            for table, columns in table_columns.items():
+                data_files[table] = stack.enter_context(open(data_dir / f"{table}{suffix}.tsv", "w", encoding="utf-8"))
+                # the header is used by install to know the columns
+                data_files[table].write("\t".join(columns) + "\n")
+        if not previous_manifest:
+            fp.write(schema_sql)
+            fp.write("\n")
         while True:
             entry = yield
             if not entry:
-                # TODO it this needed or can sql_gen be killed/gc:ed when the outer generator is done
-                sql_gen.send(None)
                 break
-            for line in sql_gen.send(entry):
-                fp.write(line)
+            if not key:
+                for table, values in insert_rows(next_id, entry):
+                    insert_row(table, values)
+                next_id += 1
+            else:
+                key_value = entry.get(key)
+                if key_value is None:
+                    raise ImportException(f'karps: entry is missing key field "{key}"')
+                if key_value in new_manifest.entries:
+                    raise ImportException(f'karps: key "{key}" is not unique, "{key_value}" appears more than once')
+                entry_hash = manifest.hash_entry(entry)
+                previous = previous_manifest.entries.pop(key_value, None) if previous_manifest else None
+                if not previous:
+                    idx = next_id
+                    next_id += 1
+                    for table, values in insert_rows(idx, entry):
+                        insert_row(table, values)
+                else:
+                    idx, previous_hash = previous
+                    if previous_hash != entry_hash:
+                        for line in update_sql(idx, entry):
+                            fp.write(line)
+                        # the main row is updated, the child rows are deleted and inserted again
+                        for table, values in insert_rows(idx, entry):
+                            if table != resource_id:
+                                add_row(table, values)
+                new_manifest.entries[key_value] = (idx, entry_hash)
+        write_all_rows()
+        if previous_manifest:
+            # the entries that were not seen in this run are removed
+            for idx, _ in previous_manifest.entries.values():
+                for line in delete_sql(idx):
+                    fp.write(line)
+        elif bulk_load:
+            with open(get_index_sql_path(pipeline_config), "w") as index_fp:
+                index_fp.write(indices)
+        else:
+            # indexes are created when all data is loaded
+            fp.write(indices)
+    if key:
+        manifest.save(manifest.get_manifest_path(pipeline_config), new_manifest)
+    else:
+        # the entries can't be tracked without key, a manifest of an earlier run must not be installed with these tables
+        manifest.get_manifest_path(pipeline_config).unlink(missing_ok=True)
+
+
+def get_sql_path(pipeline_config: PipelineConfig) -> Path:
+    """
+    The SQL file with the schema and all the data, or with the changes in an incremental export
+    """
+    return get_output_dir(pipeline_config.workdir) / f"{pipeline_config.resource_id}.sql"
+
+
+def get_schema_sql_path(pipeline_config: PipelineConfig) -> Path:
+    """
+    The SQL file with the schema, when the data is written to data files for bulk loading
+    """
+    return get_output_dir(pipeline_config.workdir) / f"{pipeline_config.resource_id}_schema.sql"
+
+
+def get_index_sql_path(pipeline_config: PipelineConfig) -> Path:
+    """
+    The SQL file with the indexes, to run after the data files are loaded
+    """
+    return get_output_dir(pipeline_config.workdir) / f"{pipeline_config.resource_id}_indexes.sql"
+
+
+def get_generation_path(pipeline_config: PipelineConfig) -> Path:
+    """
+    Describes the tables created by a full export: the suffix of the new tables and the names of the tables (main
+    table first), which the new tables are renamed to by install. There is no such file for incremental exports.
+    """
+    return get_output_dir(pipeline_config.workdir) / f"{pipeline_config.resource_id}_tables.json"
+
+
+def get_data_dir(pipeline_config: PipelineConfig) -> Path:
+    """
+    The directory of the data files for bulk loading, one file for each table, named <table><suffix>.tsv
+    """
+    return get_output_dir(pipeline_config.workdir) / f"{pipeline_config.resource_id}_data"
+
+
+# escape sequences of LOAD DATA with the default FIELDS ESCAPED BY '\\'
+_data_escapes = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "\0": "\\0"})
+
+
+def _format_data_value(val) -> str:
+    """
+    Format a value for a data file, tab separated and escaped as expected by LOAD DATA
+    """
+    if val is None:
+        return "\\N"
+    elif isinstance(val, str):
+        return val.translate(_data_escapes)
+    elif isinstance(val, int) or isinstance(val, float):
+        return str(val)
+    else:
+        raise Exception("unknown type")
@@ -1,53 +1,279 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
 from io import TextIOWrapper
+import itertools
 import logging
 from pathlib import Path
+import re
 import shutil
 from typing import Iterable, Iterator
 
-import mysql.connector
-from mysql.connector.abstracts import MySQLCursorAbstract
+from mysql.connector.pooling import MySQLConnectionPool, PooledMySQLConnection
 
 from karppipeline.common import Map, get_output_dir, InstallException
+from karppipeline.modules.karps import manifest
+import karppipeline.modules.karps.export as backend_export
 from karppipeline.modules.karps.models import KarpsConfig
 from karppipeline.models import PipelineConfig
-from karppipeline.util import yaml
+from karppipeline.util import json, yaml
 from karppipeline.util.git import GitRepo
 
 logger = logging.getLogger("karps")
 
+# the tables replaced by the last install
+PREVIOUS_SUFFIX = "$prev"
 
-def add_to_db(pipeline_config: PipelineConfig, karps_config):
-    @contextmanager
-    def get_db_cursor(karps_config: KarpsConfig) -> Iterator[MySQLCursorAbstract]:
-        connection = mysql.connector.connect(
-            user=karps_config.db_user,
-            password=karps_config.db_password,
-            database=karps_config.db_database,
+
+def add_to_db(pipeline_config: PipelineConfig, karps_config: KarpsConfig):
+    resource_id = pipeline_config.resource_id
+    # a full export creates new tables that replace the tables in use after they are loaded, an incremental
+    # export changes the tables in use
+    generation_path = backend_export.get_generation_path(pipeline_config)
+    generation = json.loads(generation_path.read_bytes()) if generation_path.exists() else None
+    # the manifest of an incremental export is moved when it is installed, and the changes can't be applied twice
+    if not generation and not manifest.get_manifest_path(pipeline_config).exists():
+        raise InstallException("karps: the changes in the SQL file are already installed, run again to update")
+
+    # the export writes either an SQL file, or a schema SQL file and data files for bulk loading
+    sql_path = backend_export.get_sql_path(pipeline_config)
+    data_dir = None if sql_path.exists() else backend_export.get_data_dir(pipeline_config)
+    pool = MySQLConnectionPool(
+        pool_name="karps",
+        # one connection for the main table and the SQL, the rest for loading other tables
+        pool_size=1 + (karps_config.install_workers if data_dir else 0),
+        user=karps_config.db_user,
+        password=karps_config.db_password,
+        database=karps_config.db_database,
+        # LOAD DATA LOCAL INFILE is only allowed for the data files
+        allow_local_infile_in_path=str(data_dir) if data_dir else None,
+    )
+    with _get_db_connection(pool) as connection:
+        if generation:
+            # new tables left by an install that failed
+            leftover_tables = [
+                table
+                for table in _get_tables(connection, resource_id)
+                if table.endswith(backend_export.GENERATION_SUFFIXES)
+            ]
+            _drop_tables(connection, leftover_tables)
+        # the new tables are not in use until they are swapped in, so these can be committed in parts. The changes
+        # of an incremental export are made to the tables in use and committed together, so that a failed install
+        # leaves the tables as they were and can be run again.
+        commit_bytes = karps_config.install_commit_bytes if generation else None
+        if not data_dir:
+            _execute_sql_file(connection, karps_config, sql_path, commit_bytes)
+        else:
+            main_table = resource_id + (generation["suffix"] if generation else "")
+            schema_sql_path = backend_export.get_schema_sql_path(pipeline_config)
+            _execute_sql_file(connection, karps_config, schema_sql_path, commit_bytes)
+            _load_data_files(connection, pool, karps_config, data_dir, main_table)
+            index_sql_path = backend_export.get_index_sql_path(pipeline_config)
+            _execute_sql_file(connection, karps_config, index_sql_path, commit_bytes)
+    if generation:
+        with _get_db_connection(pool) as connection:
+            _swap_tables(connection, resource_id, generation["suffix"], generation["tables"])
+
+
+@contextmanager
+def _get_db_connection(pool: MySQLConnectionPool) -> Iterator[PooledMySQLConnection]:
+    """
+    Gives a connection for loading data, committed if there are no errors
+    """
+    connection = pool.get_connection()
+    try:
+        with connection.cursor() as cursor:
+            # the exported data is consistent, checking each row only slows down the load
+            cursor.execute("SET SESSION foreign_key_checks = 0, unique_checks = 0")
+        yield connection
+        connection.commit()
+    finally:
+        # returns the connection to the pool, which resets the session
+        connection.close()
+
+
+def _get_tables(connection: PooledMySQLConnection, resource_id: str) -> list[str]:
+    """
+    The tables of the resource in the database: <resource_id> and <resource_id>__<field> for the collections, with
+    or without suffix.
+    """
+    escaped = resource_id.replace("\\", "\\\\").replace("_", "\\_").replace("%", "\\%")
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()"
+            " AND (TABLE_NAME = %s OR TABLE_NAME LIKE %s OR TABLE_NAME LIKE %s)",
+            (resource_id, escaped + "$%", escaped + "\\_\\_%"),
         )
-        cursor = None
-        try:
-            cursor = connection.cursor()
-            yield cursor
-        finally:
-            if cursor:
-                cursor.close()
-            connection.commit()
-            connection.close()
-
-    sql_filename = get_output_dir(pipeline_config.workdir) / f"{pipeline_config.resource_id}.sql"
-    with open(sql_filename) as sql_file:
-        with get_db_cursor(karps_config) as cursor:
-            buffer = []
-            for line in sql_file:
-                line = line.rstrip()
-                if line:
-                    buffer.append(line)
-                    if line[-1] == ";":
-                        cursor.execute(" ".join(buffer))
-                        cursor.fetchall()
-                        buffer = []
+        return [table for (table,) in cursor.fetchall()]
+
+
+def _drop_tables(connection: PooledMySQLConnection, tables: list[str]) -> None:
+    if tables:
+        logger.info(f"Dropping tables: {', '.join(tables)}")
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {', '.join(f'`{table}`' for table in tables)}")
+
+
+def _swap_tables(connection: PooledMySQLConnection, resource_id: str, suffix: str, tables: list[str]) -> None:
+    """
+    Replaces the tables in use with the new tables, <table><suffix>, in one RENAME TABLE, so that Karp-S sees either
+    all the old tables or all the new tables.
+
+    The replaced tables are kept as <table>$prev until the next install. To roll back, rename <table> to something
+    else and <table>$prev to <table>.
+    """
+    current_tables = _get_tables(connection, resource_id)
+    _drop_tables(connection, [table for table in current_tables if table.endswith(PREVIOUS_SUFFIX)])
+    # tables that are not in the new generation, such as removed collections, are also replaced
+    renames = [f"`{table}` TO `{table}{PREVIOUS_SUFFIX}`" for table in current_tables if "$" not in table]
+    renames.extend(f"`{table}{suffix}` TO `{table}`" for table in tables)
+    logger.info(f"Replacing the tables of {resource_id}")
+    with connection.cursor() as cursor:
+        cursor.execute(f"RENAME TABLE {', '.join(renames)}")
+
+
+def _execute_sql_file(
+    connection: PooledMySQLConnection, karps_config: KarpsConfig, sql_path: Path, commit_bytes: int | None = None
+) -> None:
+    """
+    Runs the statements in the file, sent in batches of install_batch_bytes. To keep the transactions small,
+    there is a commit after each commit_bytes, if given, otherwise all the statements are committed together.
+    """
+    with open(sql_path) as sql_file, connection.cursor() as cursor:
+        batch: list[str] = []
+        batch_bytes = 0
+        uncommitted_bytes = 0
+
+        def execute_batch() -> None:
+            cursor.execute(";\n".join(batch))
+            # all the results must be read before the next batch
+            for _ in cursor.fetchsets():
+                pass
+
+        for statement in _split_statements(sql_file):
+            statement_bytes = len(statement.encode())
+            if batch and batch_bytes + statement_bytes > karps_config.install_batch_bytes:
+                execute_batch()
+                uncommitted_bytes += batch_bytes
+                if commit_bytes and uncommitted_bytes >= commit_bytes:
+                    connection.commit()
+                    uncommitted_bytes = 0
+                batch = []
+                batch_bytes = 0
+            batch.append(statement)
+            batch_bytes += statement_bytes + 2
+        if batch:
+            execute_batch()
+
+
+# the tokens of SQL: text, quoted strings and names, comments and the statement delimiter. "--" only starts
+# a comment when followed by whitespace
+_sql_tokens = re.compile(
+    r"""
+    (?P<text>[^'"`;\#/-]+|/(?!\*)|-(?!-\s))
+    |(?P<quoted>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)
+    |(?P<line_comment>(?:--\s|\#)[^\n]*\n)
+    |(?P<comment>/\*.*?\*/)
+    |(?P<delimiter>;)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+def _split_statements(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Splits SQL in statements, on the ; that are not in quotes or comments. Line comments are removed.
+    """
+    statement: list[str] = []
+    has_content = False
+    buffer = ""
+
+    def tokens(at_end: bool) -> Iterator[tuple[str, str]]:
+        nonlocal buffer
+        pos = 0
+        while pos < len(buffer):
+            m = _sql_tokens.match(buffer, pos)
+            if not m:
+                # a quoted string or comment that continues on the next line
+                break
+            yield m.lastgroup, m.group()
+            pos = m.end()
+        buffer = buffer[pos:]
+        if at_end and buffer:
+            raise InstallException(f"karps: unterminated quote or comment in SQL: {buffer[:100]}")
+
+    for at_end, text in itertools.chain(((False, line) for line in lines), [(True, "\n")]):
+        buffer += text
+        for kind, token in tokens(at_end):
+            if kind == "delimiter":
+                if has_content:
+                    yield "".join(statement).strip()
+                statement = []
+                has_content = False
+            elif kind != "line_comment":
+                statement.append(token)
+                has_content = has_content or kind == "quoted" or (kind == "text" and not token.isspace())
+    if has_content:
+        yield "".join(statement).strip()
+
+
+def _load_data_files(
+    connection: PooledMySQLConnection,
+    pool: MySQLConnectionPool,
+    karps_config: KarpsConfig,
+    data_dir: Path,
+    main_table: str,
+) -> None:
+    """
+    Loads the data file of each table. The main table first, then the other tables, in parallel with
+    install_workers connections.
+    """
+
+    def load(connection: PooledMySQLConnection, data_file: Path) -> None:
+        with open(data_file, encoding="utf-8") as fp:
+            columns = fp.readline().rstrip("\n").split("\t")
+        logger.info(f"Loading {data_file.name}")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"LOAD DATA LOCAL INFILE '{_escape_path(data_file)}' INTO TABLE `{data_file.stem}`"
+                f" CHARACTER SET {karps_config.db_charset}"
+                " FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' IGNORE 1 LINES"
+                f" ({', '.join(f'`{column}`' for column in columns)})"
+            )
+
+    def load_with_pool(data_file: Path) -> None:
+        with _get_db_connection(pool) as connection:
+            load(connection, data_file)
+
+    main_file = data_dir / f"{main_table}.tsv"
+    load(connection, main_file)
+    connection.commit()
+    other_files = sorted(path for path in data_dir.glob("*.tsv") if path != main_file)
+    with ThreadPoolExecutor(max_workers=karps_config.install_workers) as executor:
+        # list, to raise the first error
+        list(executor.map(load_with_pool, other_files))
+
+
+def _escape_path(path: Path) -> str:
+    return str(path.absolute()).replace("\\", "\\\\").replace("'", "\\'")
+
+
+def update_installed_manifest(pipeline_config: PipelineConfig):
+    """
+    After install, the manifest of the latest run describes the database and the next incremental run is compared to it
+    """
+    manifest_path = manifest.get_manifest_path(pipeline_config)
+    installed_manifest_path = manifest.get_installed_manifest_path(pipeline_config)
+    if backend_export.get_generation_path(pipeline_config).exists():
+        # the tables were replaced, and can be replaced again by installing the same export, so the manifest is kept
+        if manifest_path.exists():
+            shutil.copyfile(manifest_path, installed_manifest_path)
+        else:
+            # an export without key, the next incremental run must create SQL for all entries
+            installed_manifest_path.unlink(missing_ok=True)
+    else:
+        # the changes can only be installed once, see add_to_db
+        manifest_path.replace(installed_manifest_path)
 
 
 def add_config(pipeline_config: PipelineConfig, karps_config: KarpsConfig, resource_id: str):
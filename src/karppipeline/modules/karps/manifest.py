@@ -0,0 +1,66 @@
+from dataclasses import dataclass, field
+import hashlib
+from pathlib import Path
+import pickle
+
+import orjson
+
+from karppipeline.common import create_output_dir
+from karppipeline.models import Entry, PipelineConfig
+
+"""
+The manifest keeps track of which entries that are in the database, so that the next run can
+create SQL for only the entries that have changed.
+"""
+
+
+@dataclass
+class Manifest:
+    # hash of the SQL that creates the tables, a delta can only be applied to tables with the same schema
+    schema_hash: str
+    # key value -> (__id, hash of the entry)
+    entries: dict[object, tuple[int, bytes]] = field(default_factory=dict)
+
+    @property
+    def next_id(self) -> int:
+        return max((idx for idx, _ in self.entries.values()), default=-1) + 1
+
+
+def hash_schema(schema_sql: str) -> str:
+    return hashlib.blake2b(schema_sql.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def hash_entry(entry: Entry) -> bytes:
+    return hashlib.blake2b(orjson.dumps(entry, option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+
+
+def load(path: Path) -> Manifest | None:
+    if not path.exists():
+        return None
+    with open(path, "rb") as fp:
+        return pickle.load(fp)
+
+
+def save(path: Path, manifest: Manifest) -> None:
+    with open(path, "wb") as fp:
+        pickle.dump(manifest, fp)
+
+
+def get_manifest_path(pipeline_config: PipelineConfig) -> Path:
+    """
+    The manifest of the latest run
+    """
+    return _get_module_dir(pipeline_config) / "manifest.pickle"
+
+
+def get_installed_manifest_path(pipeline_config: PipelineConfig) -> Path:
+    """
+    The manifest of the latest run that was installed
+    """
+    return _get_module_dir(pipeline_config) / "installed_manifest.pickle"
+
+
+def _get_module_dir(pipeline_config: PipelineConfig) -> Path:
+    module_dir = create_output_dir(pipeline_config.workdir) / "karps"
+    module_dir.mkdir(exist_ok=True)
+    return module_dir
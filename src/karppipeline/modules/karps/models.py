@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from karppipeline.models import MultiLang
 
@@ -45,3 +45,22 @@ class KarpsConfig(BaseModel):
     # give either primary or secondary, depending on which list is easiest to populate. the other list will be populated automatically
     primary: list[str] = []
     secondary: list[str] = []
+    # a field with a unique value for each entry, gives entries the same __id in each run
+    key: str | None = None
+    # only create SQL for the entries that changed since the last install, requires key
+    incremental: bool = False
+    # rows are inserted with multi-row INSERT statements, with at most this many rows per statement
+    insert_batch_size: int = 1000
+    # and at most this many bytes per statement, must be less than max_allowed_packet of the database server
+    insert_max_bytes: int = 1024 * 1024
+    # write the data as one file per table and install with LOAD DATA LOCAL INFILE, local_infile must be enabled in
+    # the database server. Incremental changes are still written as SQL
+    bulk_load: bool = False
+    # install sends statements in batches of at most this many bytes, must be less than max_allowed_packet
+    install_batch_bytes: int = 1024 * 1024
+    # install commits after this many bytes of statements, to keep the transactions small. Not for incremental
+    # exports, the changes to the tables in use are committed together
+    install_commit_bytes: int = 64 * 1024 * 1024
+    # number of connections used to load the data files of the collection tables in parallel, with bulk_load. The
+    # connection pool has at most 32 connections, one of them loads the main table
+    install_workers: int = Field(1, ge=1, le=31)
@@ -1,17 +1,27 @@
+import logging
 from pathlib import Path
+import time
 from typing import Callable, Sequence
 import urllib.request
 from json import JSONDecodeError
 from urllib.error import HTTPError, URLError
 from karppipeline.common import create_output_dir
+from karppipeline.modules.sbxmetadata.models import SbxMetadataConfig
+from karppipeline.util import cache
 import karppipeline.util.json as json
 
 from karppipeline.models import Entry, PipelineConfig
 
-__all__ = ["export", "load", "dependencies"]
+__all__ = ["export", "load", "dependencies", "has_entry_tasks", "external_inputs"]
+logger = logging.getLogger(__name__)
+
+# seconds to wait before the first retry, doubled for each retry
+RETRY_DELAY = 1.0
 
 
 dependencies = []
+# the metadata is fetched by the export, there are no entry tasks
+has_entry_tasks = False
 
 
 def export(
@@ -21,12 +31,25 @@ def export(
     """
     Fetches available metadata from SBX metadata API.
     """
-    metadata = _fetch_metadata_from_api(config.resource_id)
+    metadata = _fetch_metadata_from_api(config.resource_id, _get_module_config(config))
     with open(_get_data_path(config), "w") as fp:
         fp.write(json.dumps(metadata))
     return ()
 
 
+def external_inputs(config: PipelineConfig) -> str | None:
+    """
+    The cached response of the metadata API, included in the fingerprint of the module so that the module (and the
+    modules that depend on it) runs again when the metadata is changed. Nothing is fetched, None if the cached
+    response is missing or older than cache_ttl, then the module must run to fetch it.
+    """
+    module_config = _get_module_config(config)
+    cached = _read_cache(_get_cache_path(config.resource_id))
+    if cached and (module_config.offline or _is_fresh(cached, module_config)):
+        return cached["body"]
+    return None
+
+
 def load(config) -> dict[str, object]:
     with open(_get_data_path(config)) as fp:
         metadata = json.loads(fp.read())
@@ -39,16 +62,12 @@ def _get_data_path(config) -> Path:
     return module_dir / "metadata.json"
 
 
-def _fetch_metadata_from_api(resource_id) -> dict[str, object]:
-    url = f"https://ws.spraakbanken.gu.se/ws/metadata/v3/?resource={resource_id}&legacy=false"
-    req = urllib.request.Request(url)
-    try:
-        with urllib.request.urlopen(req) as resp:
-            body = resp.read().decode("utf-8")
-    except HTTPError as e:
-        raise RuntimeError(f"Error when calling metadata API on {url}") from e
-    except URLError as e:
-        raise RuntimeError(f"Metadata API not reachable on {url}") from e
+def _get_module_config(config) -> SbxMetadataConfig:
+    return SbxMetadataConfig.model_validate(config.modules.get("sbxmetadata", {}))
+
+
+def _fetch_metadata_from_api(resource_id, module_config: SbxMetadataConfig) -> dict[str, object]:
+    body = _fetch_body(resource_id, module_config)
     try:
         metadata = json.loads(body)
         if metadata:
@@ -73,3 +92,66 @@ def _fetch_metadata_from_api(resource_id) -> dict[str, object]:
         return metadata
     except JSONDecodeError:
         return {}
+
+
+def _fetch_body(resource_id: str, module_config: SbxMetadataConfig) -> str:
+    """
+    Gives the response of the metadata API, from the cache if it is younger than cache_ttl. Older responses are
+    revalidated with ETag and If-Modified-Since, if the API can't be reached the old response is used.
+    """
+    url = f"https://ws.spraakbanken.gu.se/ws/metadata/v3/?resource={resource_id}&legacy=false"
+    cache_path = _get_cache_path(resource_id)
+    cached = _read_cache(cache_path)
+    if module_config.offline:
+        if not cached:
+            raise RuntimeError(f"Metadata for {resource_id} is not cached in {cache_path}, can't fetch it offline")
+        return cached["body"]
+    if cached and _is_fresh(cached, module_config):
+        return cached["body"]
+
+    headers = {}
+    if cached and cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached["last_modified"]:
+        headers["If-Modified-Since"] = cached["last_modified"]
+    req = urllib.request.Request(url, headers=headers)
+    for attempt in range(module_config.retries + 1):
+        if attempt:
+            time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+        try:
+            with urllib.request.urlopen(req, timeout=module_config.timeout) as resp:
+                response = {
+                    "body": resp.read().decode("utf-8"),
+                    "etag": resp.headers.get("ETag"),
+                    "last_modified": resp.headers.get("Last-Modified"),
+                }
+            break
+        except HTTPError as e:
+            if e.code == 304 and cached:
+                # not modified
+                response = cached
+                break
+            if e.code < 500 and e.code != 429:
+                raise RuntimeError(f"Error when calling metadata API on {url}") from e
+            message, cause = f"Error when calling metadata API on {url}", e
+        except (URLError, TimeoutError) as e:
+            message, cause = f"Metadata API not reachable on {url}", e
+    else:
+        if cached:
+            logger.warning(f"{message}, using metadata cached {time.ctime(cached['fetched'])}")
+            return cached["body"]
+        raise RuntimeError(message) from cause
+    cache.write(cache_path, json.dumps(response | {"fetched": time.time()}).encode())
+    return response["body"]
+
+
+def _get_cache_path(resource_id: str) -> Path:
+    return cache.get_cache_dir("sbxmetadata") / f"{resource_id}.json"
+
+
+def _read_cache(cache_path: Path) -> dict[str, object] | None:
+    return json.loads(cache_path.read_bytes()) if cache_path.exists() else None
+
+
+def _is_fresh(cached: dict[str, object], module_config: SbxMetadataConfig) -> bool:
+    return time.time() - cached["fetched"] < module_config.cache_ttl
@@ -0,0 +1,13 @@
+from pydantic import BaseModel
+
+
+class SbxMetadataConfig(BaseModel):
+    # the metadata is cached on disk (see karppipeline.util.cache) and fetched again after this many seconds, then only
+    # downloaded if it has changed
+    cache_ttl: int = 24 * 60 * 60
+    # only use the cached metadata, fails if a resource has none
+    offline: bool = False
+    # seconds to wait for the metadata API
+    timeout: float = 30
+    # number of new attempts when the metadata API can't be reached or gives a server error
+    retries: int = 3
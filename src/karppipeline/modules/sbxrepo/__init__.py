@@ -7,10 +7,12 @@ from karppipeline.models import Entry, PipelineConfig
 generate SBX metadata file
 """
 
-__all__ = ["export", "install", "dependencies"]
+__all__ = ["export", "install", "dependencies", "has_entry_tasks"]
 
 
 dependencies = ["sbxmetadata", "schema"]
+# only the metadata and the schema are used, not the entries
+has_entry_tasks = False
 
 
 def export(config: PipelineConfig, module_data: dict[str, Any]) -> Sequence[Callable[[Entry], Entry]]:
@@ -1,6 +1,11 @@
 from datetime import datetime
+import functools
+import hashlib
+import logging
+import time
 from typing import cast
 import urllib.request
+from urllib.error import URLError
 from karppipeline.common import ImportException
 from karppipeline.util.frozendict import frozendict
 
@@ -9,9 +14,14 @@ import jsonschema_rs
 
 from karppipeline.models import PipelineConfig
 from karppipeline.modules.sbxrepo.models import SBXRepoConfig
-from karppipeline.util import json, yaml
+from karppipeline.util import cache, json, yaml
 from karppipeline.modules.sbxrepo.common import _get_config, _get_metadata_file
 
+logger = logging.getLogger(__name__)
+
+# seconds before a cached JSON schema is downloaded again
+SCHEMA_TTL = 24 * 60 * 60
+
 
 def _create_sb_metadata_file(pipeline_config: PipelineConfig, size, metadata: dict[str, object]):
     sbxmetadata_config: SBXRepoConfig = _get_config(pipeline_config)
@@ -83,18 +93,63 @@ def _create_sb_metadata_file(pipeline_config: PipelineConfig, size, metadata: di
             raise RuntimeError("sbxrepo: 'contact_info' not found")
         metadata["contact_info"] = sbxmetadata_config.metadata.fallbacks.contact_info
 
-    # load and test against JSON schema for SBX metadata
-    with urllib.request.urlopen(sbxmetadata_config.metadata.schema_) as response:
-        content = response.read().decode("utf-8")
-        schema = json.loads(content)
-    try:
-        jsonschema_rs.validate(schema, metadata)
-    except jsonschema_rs.ValidationError as exc:
-        raise ImportError("metadata file not valid") from exc
+    # test against JSON schema for SBX metadata
+    _validate(sbxmetadata_config.metadata.schema_, metadata)
 
     with open(_get_metadata_file(pipeline_config), "w") as fp:
         yaml.dump(metadata, fp)
 
 
+def _validate(schema_url: str, metadata: dict[str, object]) -> None:
+    """
+    Validates metadata with the JSON schema at schema_url, all errors are reported
+    """
+    validator = _get_validator(_get_schema_checksum(schema_url))
+    errors = [
+        f"{'/'.join(map(str, error.instance_path))}: {error.message}" for error in validator.iter_errors(metadata)
+    ]
+    if errors:
+        raise ImportError("metadata file not valid:\n" + "\n".join(errors))
+
+
+@functools.cache
+def _get_schema_checksum(url: str) -> str:
+    """
+    Gives the checksum of the JSON schema at url, which is cached on disk under its checksum. The schema is downloaded
+    again (once per process) when the cached version is older than SCHEMA_TTL, the cached version is used if the
+    download fails.
+    """
+    cache_dir = cache.get_cache_dir("jsonschema")
+    index_path = cache_dir / "index.json"
+    index = json.loads(index_path.read_bytes()) if index_path.exists() else {}
+    cached = index.get(url)
+    if cached and time.time() - cached["fetched"] < SCHEMA_TTL and (cache_dir / f"{cached['sha256']}.json").exists():
+        return cached["sha256"]
+    try:
+        with urllib.request.urlopen(url, timeout=30) as response:
+            content = response.read()
+    except (URLError, TimeoutError):
+        if not cached:
+            raise
+        logger.warning(f"Could not download JSON schema {url}, using the cached version")
+        return cached["sha256"]
+    checksum = hashlib.sha256(content).hexdigest()
+    cache.write(cache_dir / f"{checksum}.json", content)
+    # another process may have updated the index in between
+    index = json.loads(index_path.read_bytes()) if index_path.exists() else {}
+    index[url] = {"sha256": checksum, "fetched": time.time()}
+    cache.write(index_path, json.dumps(index).encode())
+    return checksum
+
+
+@functools.cache
+def _get_validator(checksum: str) -> jsonschema_rs.Validator:
+    """
+    The compiled validator for a cached JSON schema, compiled once per process
+    """
+    schema = json.loads((cache.get_cache_dir("jsonschema") / f"{checksum}.json").read_bytes())
+    return jsonschema_rs.validator_for(schema)
+
+
 def _get_current_date_string():
     return datetime.now().strftime("%Y-%m-%d")
@@ -1,18 +1,30 @@
+import itertools
 import logging
 from pathlib import Path
 import pickle
-from karppipeline.common import create_output_dir
+import time
+from typing import Iterator
+from karppipeline import report
+from karppipeline.common import create_output_dir, get_output_dir
+from karppipeline.models import Entry
 from karppipeline.modules.schema.entry_task import get_entry_converter
-from karppipeline.modules.schema.schema_creator import pre_import_resource
-from karppipeline.util import json
+from karppipeline.modules.schema.models import SchemaConfig
+from karppipeline.modules.schema.schema_creator import get_unspooled_range, pre_import_resource
+from karppipeline.read import read_data
+from karppipeline.util import json, spool
 
 logger = logging.getLogger(__name__)
 
-__all__ = ["export", "dependencies", "load"]
+__all__ = ["export", "dependencies", "soft_dependencies", "load", "entries", "previous_size"]
 
 
-# generate schema, source_order and size, TODO sbxmetadata should be an optional dependency
-dependencies = ["sbxmetadata"]
+# generate schema, source_order and size
+dependencies = []
+# the schema does not use the metadata, so it is inferred while the metadata is fetched
+soft_dependencies = ["sbxmetadata"]
+# the entry task converts the entries, so the schema is run again with any module with entry tasks that depends on it
+# (directly or not)
+modifies_entries = True
 
 
 def export(config, _):
@@ -22,10 +34,22 @@ def export(config, _):
     Returns the task for doing all field conversions.
     """
     # pre-import tasks, invoke conversions to know which fields *will* be there
-    entry_schema, source_order, [size] = pre_import_resource(config)
+    module_config = _get_module_config(config)
+    spool_path = _get_spool_path(config)
+    # remove entries spooled by an earlier run
+    spool.remove_parts(spool_path)
+    start = time.perf_counter()
+    entry_schema, source_order, [size] = pre_import_resource(
+        config,
+        spool_path=spool_path if module_config.single_pass else None,
+        workers=module_config.workers,
+        state_path=_get_state_path(config) if module_config.incremental else None,
+    )
+    if run_report := report.get_current():
+        run_report.add_pass("schema", size, time.perf_counter() - start)
 
     # modifies entry_schema based on config and returns modification task for entries
-    entry_converter = get_entry_converter(config, entry_schema)
+    entry_converter = get_entry_converter(config, entry_schema, module_config.converter_cache_size)
 
     logger.info("Using entry schema: " + json.dumps(entry_schema))
 
@@ -41,7 +65,51 @@ def load(config) -> dict[str, object]:
         return pickle.load(fp)
 
 
-def _get_data_path(config) -> Path:
+def previous_size(config) -> int | None:
+    """
+    The number of entries found by the last run, None if the resource has not been run
+    """
+    data_path = get_output_dir(config.workdir) / "schema" / "schema.pickle"
+    if not data_path.exists():
+        return None
+    with open(data_path, "rb") as fp:
+        return pickle.load(fp)["size"]
+
+
+def entries(config) -> Iterator[Entry]:
+    """
+    Gives the entries for the export pass. In single pass mode, the entries spooled by export
+    are replayed, otherwise the source file is read again.
+    """
+    module_config = _get_module_config(config)
+    if module_config.single_pass:
+        # with incremental inference, only the appended entries were parsed
+        unspooled = get_unspooled_range(_get_state_path(config)) if module_config.incremental else None
+        if unspooled:
+            return itertools.chain(
+                read_data(config, byte_range=unspooled)[2], spool.read_parts(_get_spool_path(config))
+            )
+        return spool.read_parts(_get_spool_path(config))
+    return read_data(config)[2]
+
+
+def _get_module_config(config) -> SchemaConfig:
+    return SchemaConfig.model_validate(config.modules.get("schema", {}))
+
+
+def _get_module_dir(config) -> Path:
     module_dir = create_output_dir(config.workdir) / "schema"
     module_dir.mkdir(exist_ok=True)
-    return module_dir / "schema.pickle"
+    return module_dir
+
+
+def _get_data_path(config) -> Path:
+    return _get_module_dir(config) / "schema.pickle"
+
+
+def _get_state_path(config) -> Path:
+    return _get_module_dir(config) / "inference.pickle"
+
+
+def _get_spool_path(config) -> Path:
+    return _get_module_dir(config) / "entries.spool"
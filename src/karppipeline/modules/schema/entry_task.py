@@ -1,16 +1,63 @@
+import functools
 import importlib
 import logging
-from typing import Any, Iterator, Callable
+import re
+import time
+from typing import Any, Callable, Sequence
 import unicodedata
-from karppipeline.models import EntrySchema, PipelineConfig, Entry, InferredField
+from karppipeline import report
+from karppipeline.converters import is_pure, memoize
+from karppipeline.models import EntrySchema, ExportFieldConfig, PipelineConfig, Entry, InferredField
 
 logger = logging.getLogger(__name__)
 
 
-def get_entry_converter(config: PipelineConfig, entry_schema: EntrySchema) -> Callable[[Entry], Entry]:
+class EntryConverter:
+    """
+    The entry task of the schema module, see get_entry_converter. When closed, it logs how well the caches of
+    the pure converters worked and the time spent in each converter when converting batches.
+    """
+
+    def __init__(
+        self,
+        convert: Callable[[Entry], Entry],
+        convert_batch: Callable[[Sequence[Entry]], list[Entry]],
+        memoized: dict[str, Callable],
+        timings: dict[str, list[float]],
+    ):
+        self.convert = convert
+        self.batch = convert_batch
+        self.memoized = memoized
+        # converter name -> [number of values, seconds]
+        self.timings = timings
+
+    def __call__(self, entry: Entry, /) -> Entry:
+        return self.convert(entry)
+
+    def close(self) -> None:
+        for name, convert_value in self.memoized.items():
+            info = convert_value.cache_info()
+            if not info.hits + info.misses:
+                # only the batch version of the converter was used
+                continue
+            logger.info(
+                f"converter {name}: {info.hits} cache hits, {info.misses} cache misses, {info.currsize} values cached"
+            )
+        run_report = report.get_current()
+        for name, (values, seconds) in self.timings.items():
+            logger.info(f"converter {name}: {values} values converted in {seconds:.2f} s")
+            if run_report:
+                run_report.add_converter(name, int(values), seconds)
+
+
+def get_entry_converter(
+    config: PipelineConfig, entry_schema: EntrySchema, converter_cache_size: int | None = None
+) -> EntryConverter:
     """
     Check if config contains any renames or conversions
     Update the entry schema and each entry with this information
+
+    The results of pure converters are cached, at most converter_cache_size values per converter.
     """
 
     def _get_converter(converter: str) -> dict[str, Callable[[object], object]]:
@@ -18,7 +65,9 @@ def get_entry_converter(config: PipelineConfig, entry_schema: EntrySchema) -> Ca
         mod = importlib.import_module("karppipeline.converters." + module)
         func_obj = getattr(mod, func)
         update_schema = getattr(mod, func + "_update_schema")
-        return {"update_schema": update_schema, "convert": func_obj}
+        # optional, converts a list of values
+        convert_batch = getattr(mod, func + "_batch", None)
+        return {"update_schema": update_schema, "convert": func_obj, "convert_batch": convert_batch}
 
     add_all = False
     converted_fields = []
@@ -50,59 +99,167 @@ def get_entry_converter(config: PipelineConfig, entry_schema: EntrySchema) -> Ca
             converters[field.converter] = _get_converter(field.converter)
             entry_schema[field.target] = converters[field.converter]["update_schema"](entry_schema[field.target])
 
-    def _convert_value(converter: str | None, val: Any) -> Any:
-        if converter:
-            return converters[converter]["convert"](config.resource_id, val)
-        return val
+    memoized = {}
+    if converter_cache_size:
+        for name, converter in converters.items():
+            if is_pure(converter["convert"]):
+                memoized[name] = memoize(converter["convert"], config.resource_id, converter_cache_size)
+
+    timings = {name: [0, 0.0] for name in converters}
+    convert, convert_batch = _compile_entry_converter(
+        config.resource_id, entry_schema, converted_fields, converters, memoized, timings
+    )
+    return EntryConverter(convert, convert_batch, memoized, timings)
+
+
+def _compile_entry_converter(
+    resource_id: str,
+    entry_schema: EntrySchema,
+    converted_fields: list[ExportFieldConfig],
+    converters: dict[str, dict[str, Callable]],
+    memoized: dict[str, Callable],
+    timings: dict[str, list[float]],
+) -> tuple[Callable[[Entry], Entry], Callable[[Sequence[Entry]], list[Entry]]]:
+    """
+    Creates the functions that convert an entry and a batch of entries, generated from the config so that the field
+    settings are only resolved once and not for every entry:
+    - copy the fields in the entry schema, in schema order, cleaning text fields
+    - rename/convert the fields given in export.fields, memoized converters are called with only the value. For
+      batches, the values of a field are collected in a list and given to the <converter>_batch function if there
+      is one and the converter is not memoized (the cache would not be used). The time of each converter is added
+      to timings, per batch so that timing is cheap
+    - clean the text fields that were set by a rename/conversion
+    """
+    namespace: dict[str, Any] = {
+        "_clean_text": _clean_text,
+        "_resource_id": resource_id,
+        "_perf_counter": time.perf_counter,
+    }
+    targets = {field.target for field in converted_fields if not field.exclude}
+
+    def clean(key: str, value: str) -> str:
+        field = entry_schema[key]
+        if field.type != "text":
+            return value
+        if not field.collection:
+            return f"_clean_text({value})"
+        # this also causes all None to be []
+        return f"[_clean_text(text) for text in {value} or []]"
+
+    copy_lines = ["new_entry = {}"]
+    for key in entry_schema.keys():
+        value = f"entry[{key!r}]" if key in targets else clean(key, f"entry[{key!r}]")
+        copy_lines.append(f"if {key!r} in entry:")
+        copy_lines.append(f"    new_entry[{key!r}] = {value}")
+    clean_lines = []
+    for key in entry_schema.keys():
+        if key in targets:
+            clean_lines.append(f"new_entry[{key!r}] = {clean(key, f'new_entry[{key!r}]')}")
+
+    lines = ["def convert(entry):", *(f"    {line}" for line in copy_lines)]
+    batch_lines = [
+        "def convert_batch(entries):",
+        "    new_entries = []",
+        "    for entry in entries:",
+        *(f"        {line}" for line in copy_lines),
+        "        new_entries.append(new_entry)",
+    ]
+    for i, field in enumerate(converted_fields):
+        if field.exclude:
+            continue
+        value = "entry" if field.name == "*" else f"entry[{field.name!r}]"
+        is_memoized = field.converter in memoized and field.name != "*"
+        if is_memoized:
+            namespace[f"_convert_{i}"] = memoized[field.converter]
+            converted_value = f"_convert_{i}({value})"
+        elif field.converter:
+            namespace[f"_convert_{i}"] = converters[field.converter]["convert"]
+            converted_value = f"_convert_{i}(_resource_id, {value})"
+        else:
+            converted_value = value
+        lines.append(f"    new_entry[{field.target!r}] = {converted_value}")
+
+        # memoized converters are called per value also in batches, so that repeated values are cached
+        if not is_memoized and field.converter and converters[field.converter]["convert_batch"]:
+            namespace[f"_convert_batch_{i}"] = converters[field.converter]["convert_batch"]
+            column = f"_convert_batch_{i}(_resource_id, [{value} for entry in entries])"
+        else:
+            column = f"[{converted_value} for entry in entries]"
+        if field.converter:
+            namespace[f"_timing_{i}"] = timings[field.converter]
+            batch_lines.append("    start = _perf_counter()")
+            batch_lines.append(f"    column = {column}")
+            batch_lines.append(f"    _timing_{i}[0] += len(column)")
+            batch_lines.append(f"    _timing_{i}[1] += _perf_counter() - start")
+            column = "column"
+        batch_lines.append(f"    for new_entry, value in zip(new_entries, {column}):")
+        batch_lines.append(f"        new_entry[{field.target!r}] = value")
+    lines.extend(f"    {line}" for line in clean_lines)
+    lines.append("    return new_entry")
+    if clean_lines:
+        batch_lines.append("    for new_entry in new_entries:")
+        batch_lines.extend(f"        {line}" for line in clean_lines)
+    batch_lines.append("    return new_entries")
+    exec("\n".join(lines + batch_lines), namespace)
+    return namespace["convert"], namespace["convert_batch"]
+
+
+def _clean_char(c: str) -> str | None:
+    """
+    What _clean_text replaces a character with, None if the character is removed
+    """
+    if c == "\n":
+        return c
+    cat = unicodedata.category(c)
+    # remove all control characters (Cc), formatting characters (Cf), unassigned characters(Cn)
+    if cat in {"Cc", "Cf", "Cn"}:
+        return None
+    if cat == "Zs":
+        # normalize space separators
+        return " "
+    return c
+
 
-    def convert(entry: Entry) -> Entry:
-        logger.debug("schema entry task")
-        new_entry = {}
+class _CleanTextTable(dict[int, str | None]):
+    """
+    Translation table for str.translate, filled in with _clean_char as new characters are seen
+    """
 
-        # initialize data
-        for key in entry_schema.keys():
-            if key in entry:
-                new_entry[key] = entry[key]
+    def __missing__(self, codepoint: int) -> str | None:
+        replacement = self[codepoint] = _clean_char(chr(codepoint))
+        return replacement
 
-        # convert or rename fields
-        for field in converted_fields:
-            if not field.exclude:
-                if field.name == "*":
-                    new_entry[field.target] = _convert_value(field.converter, entry)
-                else:
-                    val = entry[field.name]
-                    new_entry[field.target] = _convert_value(field.converter, val)
 
-        # clean up all text fields
-        for key in entry_schema.keys():
-            if entry_schema[key].type == "text" and key in new_entry:
-                if not entry_schema[key].collection:
-                    new_entry[key] = _clean_text(new_entry[key])
-                else:
-                    # this also causes all None to be []
-                    new_entry[key] = [_clean_text(text) for text in new_entry[key] or []]
+_clean_text_table = _CleanTextTable()
+# the ASCII characters that _clean_text changes
+_ascii_special_pattern = re.compile("[\x00-\x09\x0b-\x1f\x7f]")
 
-        return new_entry
 
-    return convert
+@functools.cache
+def _special_pattern() -> re.Pattern[str]:
+    """
+    Matches the characters that _clean_text might change: all characters except those in the Basic Multilingual Plane
+    that are left unchanged. Created on first use, since it looks at every character in the plane.
+    """
+    ranges: list[tuple[int, int]] = []
+    for codepoint in range(0x10000):
+        c = chr(codepoint)
+        if unicodedata.category(c) == "Cs" or _clean_char(c) != c:
+            continue
+        if ranges and ranges[-1][1] == codepoint - 1:
+            ranges[-1] = (ranges[-1][0], codepoint)
+        else:
+            ranges.append((codepoint, codepoint))
+    return re.compile(f"[^{''.join(f'{re.escape(chr(start))}-{re.escape(chr(end))}' for start, end in ranges)}]")
 
 
 def _clean_text(text: str) -> str:
     """
     Removes control characters, formatting characters, unassigned characters and makes all spaces into "normal" space
     """
-
-    def inner(text) -> Iterator[str]:
-        for c in text:
-            cat = unicodedata.category(c)
-            if c == "\n":
-                yield c
-            # remove all control characters (Cc), formatting characters (Cf), unassigned characters(Cn)
-            elif cat not in {"Cc", "Cf", "Cn"}:
-                if cat == "Zs":
-                    # normalize space separators
-                    yield " "
-                else:
-                    yield c
-
-    return "".join(inner(text))
+    if text.isascii():
+        if not _ascii_special_pattern.search(text):
+            return text
+    elif not _special_pattern().search(text):
+        return text
+    return text.translate(_clean_text_table)
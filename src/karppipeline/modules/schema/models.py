@@ -0,0 +1,14 @@
+from pydantic import BaseModel
+
+
+class SchemaConfig(BaseModel):
+    # parse the source once, entries are spooled to disk during schema inference and replayed in the export pass
+    single_pass: bool = False
+    # number of processes used for schema inference, each process reads a part of the source file. For CSV,
+    # this requires that there are no line breaks inside values
+    workers: int = 1
+    # for sources that only get new lines appended: the inferred schema is saved with a checksum of the source and
+    # the next run only reads the new lines if the rest of the source is unchanged. Not used for compressed sources
+    incremental: bool = False
+    # max number of values cached for each pure converter used in export.fields, 0 turns off the caching
+    converter_cache_size: int = 65536
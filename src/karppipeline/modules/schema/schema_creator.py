@@ -1,29 +1,275 @@
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import hashlib
+import logging
+import multiprocessing
+from pathlib import Path
+import pickle
 from typing import Iterator, cast
 from karppipeline.common import ImportException
 from karppipeline.models import EntrySchema, PipelineConfig, Entry, InferredField
-from karppipeline.read import read_data
+from karppipeline.read import (
+    SourceOrderTracker,
+    can_split_source,
+    find_source_file,
+    get_column_type_inference,
+    get_column_types,
+    read_data,
+    split_source,
+    update_column_type_inference,
+)
+from karppipeline.util import spool
+
+logger = logging.getLogger(__name__)
 
 type_lookup: dict[type, str] = {int: "integer", str: "text", bool: "bool", float: "float"}
 
 
-def pre_import_resource(pipeline_config: PipelineConfig) -> tuple[EntrySchema, list[str], list[int]]:
+def pre_import_resource(
+    pipeline_config: PipelineConfig, spool_path: Path | None = None, workers: int = 1, state_path: Path | None = None
+) -> tuple[EntrySchema, list[str], list[int]]:
     """
     reads source file and generates a schema, return (source order, size of resource, schema)
     source order is roughly the order that fields occur in source file
+
+    if spool_path is given, the parsed entries are also written there, so that the export pass does not need to parse
+    the source again
+
+    if workers > 1, the source file is split into chunks that are inferred in separate processes
+
+    if state_path is given, the schema is saved there together with a checksum of the part of the source file it was
+    inferred from. When the source file only has new lines appended since, only those are read, see
+    _pre_import_appended.
     """
+    result = _pre_import_appended(pipeline_config, spool_path, state_path) if state_path else None
+    if result is None:
+        result = _pre_import_all(pipeline_config, spool_path, workers)
+        if state_path:
+            _save_state(pipeline_config, state_path, result, unspooled_end=None)
+    return result
+
+
+def _pre_import_all(
+    pipeline_config: PipelineConfig, spool_path: Path | None, workers: int
+) -> tuple[EntrySchema, list[str], list[int]]:
+    if workers > 1 and not can_split_source(pipeline_config):
+        logger.info("the source file is compressed and can't be split, schema inference uses one process")
+    elif workers > 1:
+        return _pre_import_resource_parallel(pipeline_config, spool_path, workers)
+
     source_order, size, entries = read_data(pipeline_config)
+    if spool_path:
+        entries = spool.write(spool.part_path(spool_path, 0), entries)
 
     # generate schema from entries - _create_field will exaust the generator and make size updated
     fields = _create_fields(entries)
     return (fields, source_order, size)
 
 
-def _create_fields(entries: Iterator[Entry]) -> EntrySchema:
+def _pre_import_resource_parallel(
+    pipeline_config: PipelineConfig, spool_path: Path | None, workers: int
+) -> tuple[EntrySchema, list[str], list[int]]:
+    """
+    Infers a partial schema for each chunk of the source file and merges them in source order. If a chunk
+    fails, or can't be merged, it is read again with the schema so far as a starting point, which gives the
+    same result (or error) as reading the file from start to end.
+    """
+    # more chunks than workers, so that a slow chunk does not keep the other workers waiting
+    byte_ranges = split_source(pipeline_config, workers * 4)
+    column_types = get_column_types(pipeline_config)
+    spool_paths = [spool.part_path(spool_path, i) if spool_path else None for i in range(len(byte_ranges))]
+
+    schema: EntrySchema = {}
+    source_order_tracker = SourceOrderTracker()
+    size = 0
+    # the exports run in threads, and forking a process with threads may deadlock the child, so the workers are
+    # started from a fork server
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("forkserver"), initializer=_init_worker
+    ) as executor:
+        futures = [
+            executor.submit(_infer_chunk, pipeline_config, byte_range, column_types, chunk_spool_path)
+            for byte_range, chunk_spool_path in zip(byte_ranges, spool_paths)
+        ]
+        for future, byte_range, chunk_spool_path in zip(futures, byte_ranges, spool_paths):
+            try:
+                chunk_schema, list_keys, chunk_source_order, chunk_size = future.result()
+                schema = _merge_schemas(schema, chunk_schema, list_keys)
+            except ImportException:
+                # raises the error with the correct row number, unless the error was caused by not knowing
+                # what the previous chunks contained
+                chunk_source_order, chunk_sizes, entries = read_data(
+                    pipeline_config, byte_range=byte_range, column_types=column_types
+                )
+                if chunk_spool_path:
+                    entries = spool.write(chunk_spool_path, entries)
+                schema = _create_fields(entries, schema=copy.deepcopy(schema), start_row=size)
+                chunk_size = chunk_sizes[0]
+            source_order_tracker.update(tuple(chunk_source_order))
+            size += chunk_size
+    return schema, source_order_tracker.order, [size]
+
+
+def _pre_import_appended(
+    pipeline_config: PipelineConfig, spool_path: Path | None, state_path: Path
+) -> tuple[EntrySchema, list[str], list[int]] | None:
+    """
+    If the source file starts with the same bytes as when the saved schema was inferred, the inference continues from
+    the saved schema with the appended lines, which gives the same result as reading the whole file. Returns None if
+    the whole file must be read.
+
+    Only the appended entries are spooled, see get_unspooled_range.
+    """
+    if not state_path.exists() or not can_split_source(pipeline_config):
+        return None
+    with open(state_path, "rb") as fp:
+        state = pickle.load(fp)
+    input_file = find_source_file(pipeline_config)
+    offset = state["offset"]
+    size = input_file.stat().st_size
+    if (
+        state["source"] != str(input_file)
+        or state["import_settings"] != pipeline_config.import_settings
+        or size < offset
+        or _checksum(input_file, offset) != state["checksum"]
+    ):
+        logger.info("the source file has changed, the schema is inferred from the whole file")
+        return None
+    if state.get("column_type_inference"):
+        # the CSV column types are inferred over the appended lines only
+        update_column_type_inference(pipeline_config, state["column_type_inference"], offset)
+    column_types = get_column_types(pipeline_config)
+    if state["column_types"] != column_types:
+        logger.info("the CSV column types have changed, the schema is inferred from the whole file")
+        return None
+    logger.info(f"{size - offset} bytes appended to the source file, the schema is inferred from those")
+
+    appended_order, appended_size, entries = read_data(
+        pipeline_config, byte_range=(offset, size), column_types=column_types
+    )
+    if spool_path:
+        entries = spool.write(spool.part_path(spool_path, 0), entries)
+    schema = _create_fields(entries, schema=state["schema"], start_row=state["size"])
+    source_order_tracker = SourceOrderTracker()
+    source_order_tracker.update(tuple(state["source_order"]))
+    source_order_tracker.update(tuple(appended_order))
+    result = schema, source_order_tracker.order, [state["size"] + appended_size[0]]
+    _save_state(pipeline_config, state_path, result, unspooled_end=offset if spool_path else None)
+    return result
+
+
+def _save_state(
+    pipeline_config: PipelineConfig,
+    state_path: Path,
+    result: tuple[EntrySchema, list[str], list[int]],
+    unspooled_end: int | None,
+) -> None:
+    """
+    Saves the schema, before it is modified by the export settings, and the part of the source it was inferred from.
+    unspooled_end is where the spooled entries start, if the entries before it were not spooled.
+    """
+    state_path.unlink(missing_ok=True)
+    if not can_split_source(pipeline_config):
+        # the new lines of a compressed file can't be read separately
+        return
+    input_file = find_source_file(pipeline_config)
+    offset = input_file.stat().st_size
+    with open(input_file, "rb") as fp:
+        fp.seek(max(offset - 1, 0))
+        if offset and fp.read(1) != b"\n":
+            # the last line may be continued
+            return
+    schema, source_order, [size] = result
+    unspooled = None
+    if unspooled_end:
+        # from the start of the entries (after the CSV header)
+        unspooled = (split_source(pipeline_config, 1)[0][0], unspooled_end)
+    with open(state_path, "wb") as fp:
+        pickle.dump(
+            {
+                "source": str(input_file),
+                "import_settings": pipeline_config.import_settings,
+                "column_types": get_column_types(pipeline_config),
+                "column_type_inference": get_column_type_inference(pipeline_config),
+                "schema": schema,
+                "source_order": source_order,
+                "size": size,
+                "offset": offset,
+                "checksum": _checksum(input_file, offset),
+                "unspooled": unspooled,
+            },
+            fp,
+        )
+
+
+def get_unspooled_range(state_path: Path) -> tuple[int, int] | None:
+    """
+    The byte range of the source file with the entries that were not spooled, since they were inferred in an earlier
+    run. None if all entries were spooled.
+    """
+    if not state_path.exists():
+        return None
+    with open(state_path, "rb") as fp:
+        return pickle.load(fp)["unspooled"]
+
+
+def _checksum(input_file: Path, length: int) -> str:
+    """
+    Checksum of the first length bytes of the file
+    """
+    checksum = hashlib.sha256()
+    with open(input_file, "rb") as fp:
+        while length > 0:
+            block = fp.read(min(length, 1024 * 1024))
+            if not block:
+                break
+            checksum.update(block)
+            length -= len(block)
+    return checksum.hexdigest()
+
+
+def _init_worker() -> None:
+    # the logging of the resource is not set up in the workers, and what they would log about the source file is
+    # already logged by the main process
+    logging.getLogger("karppipeline").addHandler(logging.NullHandler())
+    logging.getLogger("karppipeline").propagate = False
+
+
+def _infer_chunk(
+    pipeline_config: PipelineConfig,
+    byte_range: tuple[int, int],
+    column_types: dict[str, str],
+    spool_path: Path | None,
+) -> tuple[EntrySchema, set[str], list[str], int]:
+    """
+    Runs in a worker process, returns the schema for the given part of the source file, together with the keys
+    that had a list value (needed when merging, since empty lists does not create fields), source order and size.
+    """
+    source_order, size, entries = read_data(pipeline_config, byte_range=byte_range, column_types=column_types)
+    if spool_path:
+        entries = spool.write(spool_path, entries)
+    list_keys = set()
+
+    def track_lists(entries: Iterator[Entry]) -> Iterator[Entry]:
+        for entry in entries:
+            for key, value in entry.items():
+                if isinstance(value, list):
+                    list_keys.add(key)
+            yield entry
+
+    schema = _create_fields(track_lists(entries))
+    return schema, list_keys, source_order, size[0]
+
+
+def _create_fields(entries: Iterator[Entry], schema: EntrySchema | None = None, start_row: int = 0) -> EntrySchema:
     """
     Goes through the entries and each key in the entries and populates schema
+
+    schema and start_row are used when continuing the work on a previously inferred schema
     """
-    schema = {}
-    for idx, entry in enumerate(entries):
+    if schema is None:
+        schema = {}
+    for idx, entry in enumerate(entries, start=start_row):
         for key in entry:
             values = entry[key]
             try:
@@ -33,6 +279,35 @@ def _create_fields(entries: Iterator[Entry]) -> EntrySchema:
     return schema
 
 
+def _merge_schemas(schema: EntrySchema, other: EntrySchema, list_keys: set[str] | None = None) -> EntrySchema:
+    """
+    Merges a schema inferred from later entries (other) into schema, using the same rules as _check_or_create_field.
+    list_keys are the keys that has list values in the later entries.
+
+    Neither schema is modified, but the result may share fields with both.
+    """
+    merged = dict(schema)
+    for key in list_keys or ():
+        field = merged.get(key)
+        if field and not field.collection:
+            raise ImportException(f'Mismatch, field: "{key}"')
+    for key, other_field in other.items():
+        field = merged.get(key)
+        if not field:
+            merged[key] = other_field
+            continue
+        if other_field.collection and not field.collection:
+            raise ImportException(f'Mismatch, field: "{key}"')
+        _check_type(key, field.type, other_field.type)
+        new_field = field.copy()
+        if field.type == "table":
+            new_field.fields = _merge_schemas(field.fields, other_field.fields)
+        elif field.type == "text":
+            new_field.extra["length"] = max(field.length, other_field.length)
+        merged[key] = new_field
+    return merged
+
+
 def _check_or_create_field(schema, key, values):
     """
     Called for each key and value in each entry
@@ -48,9 +323,11 @@ def _check_or_create_field(schema, key, values):
         raise ImportException(f'Mismatch, field: "{key}"')
     else:
         collection = True
+    fields = schema
     for value in values:
         if not isinstance(value, dict):
-            # scalar value
+            # scalar value, look the field up again since a previous value in the collection may have created it
+            field = schema.get(key)
             value = ((key, value, field),)
         elif not collection or (field and not field.type == "table"):
             # if the value is a dict, it must be in a collection and if field has been set previously
@@ -62,13 +339,12 @@ def _check_or_create_field(schema, key, values):
             collection = False
             if not field:
                 # first time this table field is found
-                fields = {}
-                field = InferredField(type="table", collection=True, name=key, fields=fields)
+                field = InferredField(type="table", collection=True, name=key, fields={})
                 schema[key] = field
 
             # use fields from the parent field as schema, will add sub-fields to the correct level
-            schema = field.fields
-            value = [(key, val, schema.get(key)) for (key, val) in value.items()]
+            fields = field.fields
+            value = [(key, val, fields.get(key)) for (key, val) in value.items()]
 
         for inner_key, inner_value, inner_field in value:
             # at this point, inner_value must be scalar otherwise the source file's entry schema is not supported
@@ -77,20 +353,18 @@ def _check_or_create_field(schema, key, values):
             if isinstance(inner_value, list) or isinstance(inner_value, dict):
                 raise ImportException("Level of nesting not allowed.")
             if inner_field:
-                _check_type(inner_key, inner_field, inner_value)
+                _check_type(inner_key, inner_field.type, type_lookup[type(inner_value)])
             else:
                 # not previously seen field, initializes type and name
                 inner_field = InferredField(type=type_lookup[type(inner_value)], name=inner_key)
                 inner_field.collection = collection
-                schema[inner_key] = inner_field
+                fields[inner_key] = inner_field
 
             if inner_field and inner_field.type == "text":
                 _add_max_length(inner_field, inner_value)
 
 
-def _check_type(key: str, field: InferredField, value: str | float | int | bool) -> None:
-    field_type = field.type
-    actual_type_name = type_lookup[type(value)]
+def _check_type(key: str, field_type: str, actual_type_name: str) -> None:
     # it is fine to first infer float and then seeing integer values
     if not (actual_type_name == "integer" and field_type == "float") and field_type != actual_type_name:
         raise ImportException(f'Mismatch, field: "{key}". Was {actual_type_name}, expected {field_type}.')
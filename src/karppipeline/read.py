@@ -1,101 +1,402 @@
+import copy
 import csv
+from dataclasses import dataclass
+import io
 import logging
-from typing import Iterator, cast
+import mmap
+import os
+from pathlib import Path
+import re
+from typing import Any, Callable, Iterator, TextIO, cast
 
+from karppipeline.common import ImportException
 from karppipeline.models import Entry, PipelineConfig
-from karppipeline.util import json
+from karppipeline.util import compression, json
 from karppipeline.util.terminal import bold
 
 logger = logging.getLogger(__name__)
 
+_csv_casts: dict[str, Callable[[str], object]] = {"int": int, "float": float}
+_int_pattern = re.compile(r"-?(0|[1-9][0-9]*)")
+_float_pattern = re.compile(r"-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?")
+_inferred_column_types: dict[tuple[str, int, int], "ColumnTypeInference"] = {}
 
-def _update_json_source_order(source_order: list[str], new_keys: list[str]) -> list[str]:
+# the number of bytes of a JSONL file that are split into lines at once
+_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+@dataclass
+class ColumnTypeInference:
     """
-    Tries to merge two lists so that the order of original list is preserved, while new
-    elements are added in between in appropriate places. If the order is conflicting
-    we don't really care what happens, order should be hard coded in cofig for those cases.
+    The inference of the CSV column types, which can be continued with more rows, see update_column_type_inference
     """
-    source_place = 0
-    for i, key in enumerate(new_keys):
-        if key in source_order:
-            source_place = source_order.index(key)
-            continue
 
-        # find anchor - find the next elment in keys that are already in
-        source_order_from_current = source_order[source_place:]
-        for future_key in new_keys[i:]:
-            if future_key in source_order_from_current:
-                # but get the index  from source_order
-                anchor_idx = source_order.index(future_key)
-                # splice in the new element immediately before anchor
-                source_order.insert(anchor_idx, key)
-                source_place = anchor_idx
-                break
-        else:
-            # anchor not found - add
-            source_order.append(key)
-    return source_order
+    header: list[str]
+    # columns that could still be numbers, with the narrowest type that fits so far
+    candidates: dict[int, str]
+    # columns with non-empty values
+    seen: set[int]
+
+    @property
+    def column_types(self) -> dict[str, str]:
+        return {self.header[i]: column_type for i, column_type in self.candidates.items() if i in self.seen}
+
+
+class SourceOrderTracker:
+    """
+    Merges the key order of entries into one list so that the order of the list is preserved, while new
+    keys are added in between in appropriate places. If the order is conflicting we don't really care
+    what happens, order should be hard coded in config for those cases.
+
+    Most entries share a few key layouts and merging a layout a second time never changes the order,
+    so layouts that have already been merged are skipped.
+    """
+
+    # when this many layouts have been seen, start over to bound memory usage
+    max_layouts = 10000
 
+    def __init__(self) -> None:
+        self.order: list[str] = []
+        self._position: dict[str, int] = {}
+        self._seen: set[tuple[str, ...]] = set()
 
-def _find_source_file(pipeline_config: PipelineConfig):
+    def update(self, keys: tuple[str, ...]) -> None:
+        if keys in self._seen:
+            return
+        if len(self._seen) >= self.max_layouts:
+            self._seen.clear()
+        self._seen.add(keys)
+
+        order = self.order
+        position = self._position
+        source_place = 0
+        for i, key in enumerate(keys):
+            key_position = position.get(key)
+            if key_position is not None:
+                source_place = key_position
+                continue
+
+            # find anchor - the next key that is already in the order, after the current place
+            for future_key in keys[i + 1 :]:
+                anchor_idx = position.get(future_key)
+                if anchor_idx is not None and anchor_idx >= source_place:
+                    # splice in the new key immediately before anchor
+                    order.insert(anchor_idx, key)
+                    for idx in range(anchor_idx, len(order)):
+                        position[order[idx]] = idx
+                    source_place = anchor_idx
+                    break
+            else:
+                # anchor not found - add
+                position[key] = len(order)
+                order.append(key)
+
+
+def find_source_file(pipeline_config: PipelineConfig):
     files = list(pipeline_config.workdir.glob("source/*"))
     if len(files) != 1:
         # we only support one input file
         logger.warning(f"pipeline supports {bold('one')} input file in source/ and will select the first file.")
-    logger.info(f"Reading source file: {files[0]}")
     return files[0]
 
 
-def read_data(pipeline_config: PipelineConfig) -> tuple[list[str], list[int], Iterator[Entry]]:
+def _is_csv(input_file: Path) -> bool:
+    return compression.content_suffix(input_file) in [".csv", ".tsv"]
+
+
+def _open_text(input_file: Path) -> TextIO:
+    if compression.is_compressed(input_file):
+        return io.TextIOWrapper(compression.open_read(input_file), encoding="utf-8-sig")
+    return open(input_file, encoding="utf-8-sig")
+
+
+def can_split_source(pipeline_config: PipelineConfig) -> bool:
+    """
+    Compressed files can't be split into byte ranges, see split_source
+    """
+    return not compression.is_compressed(find_source_file(pipeline_config))
+
+
+def _read_json_lines(input_file: Path, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+    """
+    Reads the lines of input_file that starts within [start, end), without line endings.
+
+    The file is memory mapped and split on newlines one block at a time, this avoids both decoding
+    and the per-line overhead of reading a file object.
+    """
+    if compression.is_compressed(input_file):
+        yield from _read_compressed_json_lines(input_file)
+        return
+    with open(input_file, "rb") as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size == 0:
+            # empty files can't be memory mapped
+            return
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = size if end is None else min(end, size)
+            pos = start
+            while pos < end:
+                # the block ends after the line that contains the last byte of the block
+                block_end = mm.find(b"\n", min(pos + _BLOCK_SIZE, end) - 1) + 1 or size
+                lines = mm[pos:block_end].split(b"\n")
+                if not lines[-1]:
+                    # the block ended with a newline
+                    lines.pop()
+                yield from lines
+                pos = block_end
+
+
+def _read_compressed_json_lines(input_file: Path) -> Iterator[bytes]:
+    """
+    Same as _read_json_lines, but the blocks are read from the decompressed stream
+    """
+    with compression.open_read(input_file) as fp:
+        rest = b""
+        while block := fp.read(_BLOCK_SIZE):
+            lines = (rest + block).split(b"\n")
+            # the last line continues in the next block
+            rest = lines.pop()
+            yield from lines
+        if rest:
+            yield rest
+
+
+def _read_lines(input_file: Path, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+    """
+    Reads the lines of input_file that starts within [start, end)
+    """
+    with open(input_file, "rb") as fp:
+        fp.seek(start)
+        pos = start
+        for line in fp:
+            if end is not None and pos >= end:
+                break
+            pos += len(line)
+            yield line
+
+
+def get_column_types(pipeline_config: PipelineConfig) -> dict[str, str]:
+    """
+    The types that CSV columns should be cast to, from import.csv.cast_fields and, if import.csv.infer_types
+    is set, inferred from the data. Text columns are not included. Always empty for JSON sources.
+    """
+    input_file = find_source_file(pipeline_config)
+    if not _is_csv(input_file):
+        return {}
+    import_settings = cast(dict[str, dict[str, object]], pipeline_config.import_settings)
+    csv_settings = import_settings.get("csv", {})
+
+    configured_types: dict[str, str] = {}
+    for field in cast(list[dict[str, str]], csv_settings.get("cast_fields", [])):
+        if field["type"] not in _csv_casts:
+            raise ImportException(f"Unknown type: {field['type']}, given in CSV import")
+        configured_types[field["name"]] = field["type"]
+    if not csv_settings.get("infer_types", False):
+        return configured_types
+
+    # configured types have precedence
+    return cast(ColumnTypeInference, get_column_type_inference(pipeline_config)).column_types | configured_types
+
+
+def get_column_type_inference(pipeline_config: PipelineConfig) -> ColumnTypeInference | None:
+    """
+    The inference of the CSV column types over the whole source file, None if import.csv.infer_types is not set
+    (or the source is not CSV)
+    """
+    input_file = find_source_file(pipeline_config)
+    import_settings = cast(dict[str, dict[str, object]], pipeline_config.import_settings)
+    if not _is_csv(input_file) or not import_settings.get("csv", {}).get("infer_types", False):
+        return None
+    # inference reads the whole file, do it once for each version of the file
+    cache_key = _get_cache_key(input_file)
+    if cache_key not in _inferred_column_types:
+        _inferred_column_types[cache_key] = _infer_column_types(input_file)
+        logger.info(f"Inferred CSV column types: {_inferred_column_types[cache_key].column_types}")
+    return _inferred_column_types[cache_key]
+
+
+def update_column_type_inference(
+    pipeline_config: PipelineConfig, inference: ColumnTypeInference, start: int
+) -> ColumnTypeInference:
+    """
+    Continues the inference of an earlier version of the source file with the lines appended after start, which gives
+    the same result as inferring over the whole file if the file only has had lines appended. The result is used by
+    get_column_types for the current version of the file.
+    """
+    input_file = find_source_file(pipeline_config)
+    updated = _infer_column_types(input_file, start, copy.deepcopy(inference))
+    _inferred_column_types[_get_cache_key(input_file)] = updated
+    return updated
+
+
+def _get_cache_key(input_file: Path) -> tuple[str, int, int]:
+    stat = input_file.stat()
+    return (str(input_file), stat.st_size, stat.st_mtime_ns)
+
+
+def _get_csv_dialect(input_file: Path) -> str:
+    return "excel" if compression.content_suffix(input_file) == ".csv" else "excel-tab"
+
+
+def _infer_column_types(
+    input_file: Path, start: int | None = None, inference: ColumnTypeInference | None = None
+) -> ColumnTypeInference:
+    """
+    A column is int (or float) if all non-empty values are written as integers (or numbers). Numbers with
+    leading zeros are not considered numbers, since they are probably identifiers.
+
+    If start is given, inference is continued with the lines from start, which must be after the header.
+    """
+    dialect = _get_csv_dialect(input_file)
+    with _open_text(input_file) as fp:
+        if start is None:
+            reader = csv.reader(fp, dialect=dialect)
+            header = next(reader, None) or []
+            inference = ColumnTypeInference(header, {i: "int" for i in range(len(header))}, set())
+        else:
+            reader = csv.reader((line.decode("utf-8") for line in _read_lines(input_file, start)), dialect=dialect)
+        inference = cast(ColumnTypeInference, inference)
+        candidates, seen_values = inference.candidates, inference.seen
+        for row in reader:
+            for i in list(candidates):
+                if i >= len(row) or not row[i]:
+                    continue
+                seen_values.add(i)
+                if candidates[i] == "int" and _int_pattern.fullmatch(row[i]):
+                    continue
+                if _float_pattern.fullmatch(row[i]):
+                    candidates[i] = "float"
+                else:
+                    del candidates[i]
+            if not candidates:
+                break
+    return inference
+
+
+def _compile_row_converter(header: list[str], column_types: dict[str, str]) -> Callable[[list[str]], Entry]:
+    """
+    Creates the function that turns a CSV row into an entry. It is generated as one dict literal, with the casts
+    inlined, since it is called for every row. Empty values in cast columns become None.
+
+    Rows shorter than the header only get the keys that have values, as with zip.
+    """
+    items = []
+    for i, name in enumerate(header):
+        if name in column_types:
+            items.append(f"{name!r}: _{column_types[name]}(row[{i}]) if row[{i}] else None")
+        else:
+            items.append(f"{name!r}: row[{i}]")
+    namespace: dict[str, Any] = {f"_{type_name}": func for type_name, func in _csv_casts.items()}
+    exec(f"def convert_full_row(row):\n    return {{{', '.join(items)}}}", namespace)
+    convert_full_row = namespace["convert_full_row"]
+    casts = [_csv_casts.get(column_types.get(name, "")) for name in header]
+    num_columns = len(header)
+
+    def convert_row(row: list[str]) -> Entry:
+        if len(row) >= num_columns:
+            return convert_full_row(row)
+        return {
+            name: (cast_value(value) if value else None) if cast_value else value
+            for name, value, cast_value in zip(header, row, casts)
+        }
+
+    return convert_row
+
+
+def _describe_cast_error(header: list[str], column_types: dict[str, str], row: list[str]) -> str:
+    for name, value in zip(header, row):
+        if name in column_types and value:
+            try:
+                _csv_casts[column_types[name]](value)
+            except ValueError:
+                return f'CSV value "{value}" in column "{name}" is not of type {column_types[name]}'
+    return f"CSV row could not be read: {row}"
+
+
+def split_source(pipeline_config: PipelineConfig, n: int) -> list[tuple[int, int]]:
+    """
+    Splits the source file in at most n byte ranges that start and end on line boundaries, to be given to read_data.
+    For CSV files, the first range starts after the header. Each CSV record must be on one line, i.e. line breaks inside
+    quoted values are not supported. Compressed files can't be split, see can_split_source.
+    """
+    input_file = find_source_file(pipeline_config)
+    size = input_file.stat().st_size
+    with open(input_file, "rb") as fp:
+        if _is_csv(input_file):
+            fp.readline()
+        bounds = [fp.tell()]
+        for i in range(1, n):
+            pos = bounds[0] + (size - bounds[0]) * i // n
+            if pos <= bounds[-1]:
+                continue
+            # move to the start of the next line, unless pos already is at the start of a line
+            fp.seek(pos - 1)
+            fp.readline()
+            pos = fp.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def read_data(
+    pipeline_config: PipelineConfig,
+    byte_range: tuple[int, int] | None = None,
+    column_types: dict[str, str] | None = None,
+) -> tuple[list[str], list[int], Iterator[Entry]]:
     """
     When reading CSV data, we know the fields and their order beforehand, but not for JSON
     (unless hard coded in configuration). We prepare source order here, but it is not usable
     until after the generators have been consumed, same as size.
+
+    If byte_range is given, only the entries on the lines starting in that range are read, see split_source.
+    column_types are the CSV types from get_column_types, give them when reading many ranges to only resolve them once.
     """
-    input_file = _find_source_file(pipeline_config)
+    input_file = find_source_file(pipeline_config)
+    if byte_range:
+        logger.debug(f"Reading source file: {input_file}, bytes {byte_range[0]}-{byte_range[1]}")
+    else:
+        logger.info(f"Reading source file: {input_file}")
 
     # size, array because generator needs mutable object
     size = [0]
-    if input_file.suffix in [".csv", ".tsv"]:
-        fp = open((input_file), encoding="utf-8-sig")
-        if input_file.suffix == ".csv":
-            reader = csv.reader(fp)
-        else:
-            reader = csv.reader(fp, dialect="excel-tab")
+    if _is_csv(input_file):
+        fp = _open_text(input_file)
+        dialect = _get_csv_dialect(input_file)
+        reader = csv.reader(fp, dialect=dialect)
         source_order = next(reader, None) or []
-        import_settings = cast(dict[str, dict[str, list[dict[str, str]]]], pipeline_config.import_settings)
-        # type information for parsing values
-        cast_fields: list[dict[str, str]] = import_settings["csv"]["cast_fields"]
+        if byte_range:
+            # the header is always read from the start of the file, but the rows only from the given range
+            fp.close()
+            reader = csv.reader(
+                (line.decode("utf-8") for line in _read_lines(input_file, *byte_range)), dialect=dialect
+            )
+        if column_types is None:
+            column_types = get_column_types(pipeline_config)
+        convert_row = _compile_row_converter(source_order, column_types)
 
         def get_entries() -> Iterator[Entry]:
             for row in reader:
-                entry: dict[str, str | int | float] = dict(zip(source_order, row))
-                # parse values
-                for field in cast_fields:
-                    if field["type"] == "int":
-                        entry[field["name"]] = int(entry[field["name"]])
-                    elif field["type"] == "float":
-                        entry[field["name"]] = float(entry[field["name"]])
-                    else:
-                        raise RuntimeError(f"Uknown type: {field['type']}, given in CSV import")
+                try:
+                    entry = convert_row(row)
+                except ValueError:
+                    raise ImportException(_describe_cast_error(source_order, column_types, row)) from None
                 size[0] += 1
                 yield entry
             fp.close()
 
     else:
-        fp = open(input_file)
-        source_order = []
+        source_order_tracker = SourceOrderTracker()
+        source_order = source_order_tracker.order
 
         def get_entries() -> Iterator[Entry]:
-            for line in fp:
+            for line in _read_json_lines(input_file, *(byte_range or ())):
                 entry = json.loads(line)
 
                 # get the sort order from the input JSON
                 # this could be configurable to speed up
-                keys = list(entry.keys())
-                _update_json_source_order(source_order, keys)
+                source_order_tracker.update(tuple(entry))
                 size[0] += 1
                 yield entry
-            fp.close()
 
     return source_order, size, get_entries()
@@ -0,0 +1,115 @@
+"""
+Timings of a run, written as JSON to log/report.json when the run is finished: wall and CPU time of the export and
+load of each module, time and number of entries of each entry task and converter, entries per second of each pass
+over the data and the peak memory usage.
+
+With profile, the run is also profiled with cProfile (since Python 3.12 this includes all threads) and the stats are
+written to log/profile.prof, see pstats.
+"""
+
+import cProfile
+from contextlib import contextmanager
+import resource
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterator, Sequence
+
+from karppipeline.models import Entry
+from karppipeline.util import json
+
+_current: "RunReport | None" = None
+
+
+class RunReport:
+    def __init__(self, profile: bool = False):
+        self.profile = cProfile.Profile() if profile else None
+        self.modules: dict[str, dict[str, dict[str, float]]] = {}
+        self.tasks: dict[str, dict[str, float]] = {}
+        self.converters: dict[str, dict[str, float]] = {}
+        self.passes: dict[str, dict[str, float | None]] = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, cmd: str, step: str) -> Iterator[None]:
+        """
+        Times a step of a module, for example its export. The CPU time is that of the calling thread.
+        """
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            timing = {"wall": time.perf_counter() - wall, "cpu": time.thread_time() - cpu}
+            with self.lock:
+                self.modules.setdefault(cmd, {})[step] = timing
+
+    def timed_task(
+        self, name: str, batch_task: Callable[[Sequence[Entry]], list[Entry]]
+    ) -> Callable[[Sequence[Entry]], list[Entry]]:
+        """
+        Wraps the batch function of an entry task, adding up its time and the number of entries and batches
+        """
+        timing = self.tasks[name] = {"seconds": 0.0, "entries": 0, "batches": 0}
+
+        def timed_batch_task(entries: Sequence[Entry]) -> list[Entry]:
+            start = time.perf_counter()
+            result = batch_task(entries)
+            timing["seconds"] += time.perf_counter() - start
+            timing["entries"] += len(entries)
+            timing["batches"] += 1
+            return result
+
+        return timed_batch_task
+
+    def add_pass(self, name: str, entries: int, seconds: float) -> None:
+        self.passes[name] = {
+            "entries": entries,
+            "seconds": seconds,
+            "entries_per_second": entries / seconds if seconds else None,
+        }
+
+    def add_converter(self, name: str, values: int, seconds: float) -> None:
+        self.converters[name] = {"values": values, "seconds": seconds}
+
+    def call(self, func: Callable, *args) -> object:
+        """
+        Calls func, in the profiler if the run is profiled
+        """
+        if self.profile:
+            return self.profile.runcall(func, *args)
+        return func(*args)
+
+    def write(self, log_dir: Path) -> None:
+        # ru_maxrss is in KiB on Linux, the children are the worker processes of the schema inference
+        report = {
+            "modules": self.modules,
+            "tasks": self.tasks,
+            "converters": self.converters,
+            "passes": self.passes,
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "peak_rss_children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        }
+        with open(log_dir / "report.json", "w") as fp:
+            fp.write(json.dumps(report))
+        if self.profile:
+            self.profile.dump_stats(log_dir / "profile.prof")
+
+
+@contextmanager
+def reporting(profile: bool = False) -> Iterator[RunReport]:
+    """
+    Makes a new report the current one, for the duration of a run
+    """
+    global _current
+    _current = RunReport(profile=profile)
+    try:
+        yield _current
+    finally:
+        _current = None
+
+
+def get_current() -> RunReport | None:
+    """
+    The report of the current run, None outside of a run (for example when a module is used directly)
+    """
+    return _current
@@ -1,8 +1,15 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 import importlib
+import itertools
 import logging
-from typing import Callable
+import queue
+import threading
+import time
+from types import ModuleType
+from typing import Any, Callable, Iterable, Sequence
 
-from karppipeline.common import ImportException
+from karppipeline import freshness, report
+from karppipeline.common import ImportException, create_log_dir
 from karppipeline.read import read_data
 
 from karppipeline.models import Entry, PipelineConfig
@@ -10,8 +17,19 @@ from karppipeline.models import Entry, PipelineConfig
 
 logger = logging.getLogger(__name__)
 
+# the number of entries given to each entry task at a time
+BATCH_SIZE = 1000
+# the number of batches that can wait between two stages of the entry pipeline
+QUEUE_SIZE = 4
 
-def run(config: PipelineConfig, subcommand: str = "all") -> None:
+
+def run(config: PipelineConfig, subcommand: str = "all", force: bool = False, profile: bool = False) -> bool:
+    """
+    Runs the invoked modules and their dependencies. Modules whose inputs are unchanged since their last run are
+    skipped, unless force is set. Returns False if all modules were skipped.
+
+    The timings of the run are written to log/report.json, with profile also a cProfile dump, see report.
+    """
     if subcommand == "all":
         invoked_cmds = config.export.default
     else:
@@ -20,43 +38,312 @@ def run(config: PipelineConfig, subcommand: str = "all") -> None:
     resolved_cmds = []
     mods = {}
 
+    def find(invoked_cmds):
+        """
+        Finds the modules in the run, the invoked modules and their dependencies. Soft dependencies are not added.
+        """
+        for cmd in invoked_cmds:
+            if cmd not in mods:
+                try:
+                    mods[cmd] = importlib.import_module("karppipeline.modules." + cmd)
+                except ModuleNotFoundError as e:
+                    raise ImportException(f"{cmd} not found") from e
+                find(mods[cmd].dependencies)
+
     def resolve(invoked_cmds):
         """
-        Traverses the dependency tree and adds dependencies to resolved_cmds in the order they need to run
+        Traverses the dependency tree and adds dependencies to resolved_cmds in the order they need to run, soft
+        dependencies that are in the run are added before the modules that use them
         """
         for cmd in invoked_cmds:
-            try:
-                mod = importlib.import_module("karppipeline.modules." + cmd)
-                mods[cmd] = mod
-            except ModuleNotFoundError as e:
-                raise ImportException(f"{cmd} not found") from e
-            resolve(mod.dependencies)
-            if cmd not in resolved_cmds:
-                resolved_cmds.append(cmd)
+            if cmd in mods and cmd not in resolved_cmds:
+                resolve([*mods[cmd].dependencies, *getattr(mods[cmd], "soft_dependencies", ())])
+                if cmd not in resolved_cmds:
+                    resolved_cmds.append(cmd)
 
+    find(invoked_cmds)
     resolve(invoked_cmds)
 
-    entry_tasks: list[Callable[[Entry], Entry]] = []
-    module_data = {}
+    inputs = freshness.get_inputs(config)
+    all_cmds = list(resolved_cmds)
+
+    def get_fingerprints() -> dict[str, str | None]:
+        """
+        The fingerprint of each module, None if it depends on external inputs that are not known without fetching them
+        (the module must run then, and so must the modules that depend on it)
+        """
+        fingerprints: dict[str, str | None] = {}
+        for cmd in all_cmds:
+            dependency_fingerprints = [fingerprints[dependency] for dependency in mods[cmd].dependencies]
+            fingerprints[cmd] = None
+            if None in dependency_fingerprints:
+                continue
+            external_inputs = None
+            # for example data fetched from an API, that can change without any change to the resource
+            if hasattr(mods[cmd], "external_inputs"):
+                external_inputs = mods[cmd].external_inputs(config)
+                if external_inputs is None:
+                    continue
+            fingerprints[cmd] = freshness.fingerprint(inputs, cmd, dependency_fingerprints, external_inputs)
+        return fingerprints
+
+    fingerprints = get_fingerprints()
+    saved_fingerprints = freshness.load(config)
+    run_cmds = {
+        cmd
+        for cmd in resolved_cmds
+        if force or fingerprints[cmd] is None or saved_fingerprints.get(cmd) != fingerprints[cmd]
+    }
+
+    def add_entry_modifiers(cmd: str, visited: set[str]) -> None:
+        """
+        The entries are modified by the entry tasks of the dependencies (direct or not) marked with modifies_entries,
+        these must run when cmd runs, even if they are up to date
+        """
+        for dependency in mods[cmd].dependencies:
+            if dependency not in visited:
+                visited.add(dependency)
+                if getattr(mods[dependency], "modifies_entries", False):
+                    run_cmds.add(dependency)
+                add_entry_modifiers(dependency, visited)
+
+    visited: set[str] = set()
+    # modules without entry tasks don't see the entries, so the modifiers don't have to run for them
+    for cmd in [cmd for cmd in run_cmds if getattr(mods[cmd], "has_entry_tasks", True)]:
+        add_entry_modifiers(cmd, visited)
+    if not run_cmds:
+        logger.info(f"Up to date: {', '.join(resolved_cmds)}")
+        return False
+    skipped_cmds = [cmd for cmd in resolved_cmds if cmd not in run_cmds]
+    if skipped_cmds:
+        logger.info(f"Up to date, skipping: {', '.join(skipped_cmds)}")
+    resolved_cmds = [cmd for cmd in resolved_cmds if cmd in run_cmds]
+    # the outputs of the modules are changed from here, they are up to date again when the run is finished
     for cmd in resolved_cmds:
+        saved_fingerprints.pop(cmd, None)
+    freshness.save(config, saved_fingerprints)
+
+    with report.reporting(profile) as run_report:
+        try:
+            run_report.call(_run_modules, config, mods, resolved_cmds, run_report)
+        finally:
+            run_report.write(create_log_dir(config.workdir))
+
+    # the external inputs are fetched by the run, a module whose inputs are still unknown runs again next time
+    fingerprints = get_fingerprints()
+    freshness.save(
+        config, saved_fingerprints | {cmd: fingerprints[cmd] for cmd in resolved_cmds if fingerprints[cmd] is not None}
+    )
+    return True
+
+
+def _run_modules(
+    config: PipelineConfig, mods: dict[str, ModuleType], resolved_cmds: list[str], run_report: report.RunReport
+) -> None:
+    # the exports run concurrently, each export waits for its dependencies to finish. Soft dependencies are only
+    # waited for if their data is used. Skipped modules have their data from an earlier run.
+    futures: dict[str, Future] = {}
+    module_data = ModuleData(config, mods, futures, run_report)
+
+    def export(cmd: str) -> Sequence[Callable[[Entry], Entry]]:
         mod = mods[cmd]
-        dependencies = mod.dependencies
-        for dependency in dependencies:
-            if dependency not in module_data:
-                # fetch the result from cmd's dependency
-                if hasattr(mods[dependency], "load"):
-                    module_data[dependency] = mods[dependency].load(config)
+        for dependency in mod.dependencies:
+            module_data[dependency]
+        with run_report.timed(cmd, "export"):
+            return mod.export(config, module_data)
+
+    with ThreadPoolExecutor(max_workers=len(resolved_cmds)) as executor:
+        # the modules are submitted after their dependencies, so a waiting export never blocks a dependency
+        for cmd in resolved_cmds:
+            futures[cmd] = executor.submit(export, cmd)
+
+    # callables added to entry_tasks will be called for each entry, in the order of resolved_cmds
+    entry_tasks: list[Callable[[Entry], Entry]] = []
+    task_names: list[str] = []
+    for cmd in resolved_cmds:
+        tasks = futures[cmd].result()
+        entry_tasks.extend(tasks)
+        task_names.extend(cmd if len(tasks) == 1 else f"{cmd}[{i}]" for i in range(len(tasks)))
+    if not entry_tasks:
+        return
+
+    # a module may provide the entries for the export pass (for example replaying already parsed entries),
+    # otherwise the source is read again
+    entries = None
+    for cmd in resolved_cmds:
+        if hasattr(mods[cmd], "entries"):
+            entries = mods[cmd].entries(config)
+            break
+    if entries is None:
+        entries = read_data(config)[2]
+
+    _run_stages(entries, entry_tasks, run_report, task_names)
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _Stage:
+    """
+    Tasks that run in a thread of their own, on the batches from the input queue. The result of each batch is put
+    in all the output queues.
+    """
+
+    def __init__(self, tasks: list[Callable[[Entry], Entry]], names: list[str], input: queue.Queue):
+        self.tasks = tasks
+        self.names = names
+        self.input = input
+        self.outputs: list[queue.Queue] = []
+
+
+def _run_stages(
+    entries: Iterable[Entry],
+    entry_tasks: list[Callable[[Entry], Entry]],
+    run_report: report.RunReport | None = None,
+    task_names: list[str] | None = None,
+) -> None:
+    """
+    Runs the entry tasks on batches of entries, in a pipeline of stages connected by queues of at most QUEUE_SIZE
+    batches, so that a slow stage holds back the stages before it. The entries are read in the calling thread.
+    Consecutive tasks that modify entries run in one stage, and each sink (a task marked with sink = True, that
+    doesn't change the entries) runs in a stage of its own on the output of the tasks before it. The batches
+    pass through each stage in order.
+
+    If a stage fails, the other stages are stopped and the error is raised. The tasks are only closed if all
+    entries are processed.
+
+    With run_report, the time of each task (named by task_names) and the entries per second of the pass are added
+    to the report.
+    """
+    if task_names is None:
+        task_names = [str(i) for i in range(len(entry_tasks))]
+    cancelled = threading.Event()
+    errors: list[BaseException] = []
+
+    def put(output: queue.Queue, batch: Sequence[Entry] | None) -> None:
+        while not cancelled.is_set():
+            try:
+                output.put(batch, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise _Cancelled()
+
+    def get(input: queue.Queue) -> Sequence[Entry] | None:
+        while not cancelled.is_set():
+            try:
+                return input.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        raise _Cancelled()
+
+    def fail(error: BaseException) -> None:
+        errors.append(error)
+        cancelled.set()
+
+    def run_stage(stage: _Stage) -> None:
+        try:
+            # tasks without a batch method are called for each entry
+            batch_tasks = [task.batch if hasattr(task, "batch") else _batch_task(task) for task in stage.tasks]
+            if run_report:
+                batch_tasks = [run_report.timed_task(*args) for args in zip(stage.names, batch_tasks)]
+            while (batch := get(stage.input)) is not None:
+                for batch_task in batch_tasks:
+                    batch = batch_task(batch)
+                for output in stage.outputs:
+                    put(output, batch)
+            # let the tasks know that there are no more entries
+            for task in stage.tasks:
+                if hasattr(task, "close"):
+                    task.close()
+            for output in stage.outputs:
+                put(output, None)
+        except _Cancelled:
+            pass
+        except BaseException as e:
+            fail(e)
+
+    reader_outputs: list[queue.Queue] = []
+    stages: list[_Stage] = []
+    # the last stage of tasks that modify entries, the tasks after it get its output
+    current: _Stage | None = None
+    for task, name in zip(entry_tasks, task_names):
+        is_sink = getattr(task, "sink", False)
+        if current and not current.outputs and not is_sink:
+            current.tasks.append(task)
+            current.names.append(name)
+        else:
+            stage = _Stage([task], [name], queue.Queue(maxsize=QUEUE_SIZE))
+            (current.outputs if current else reader_outputs).append(stage.input)
+            stages.append(stage)
+            if not is_sink:
+                current = stage
+
+    threads = [threading.Thread(target=run_stage, args=(stage,), daemon=True) for stage in stages]
+    start = time.perf_counter()
+    count = 0
+    for thread in threads:
+        thread.start()
+    try:
+        for batch in itertools.batched(entries, BATCH_SIZE):
+            count += len(batch)
+            for output in reader_outputs:
+                put(output, batch)
+        for output in reader_outputs:
+            put(output, None)
+    except _Cancelled:
+        pass
+    except BaseException as e:
+        fail(e)
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    if run_report:
+        run_report.add_pass("entries", count, time.perf_counter() - start)
+
+
+class ModuleData:
+    """
+    The data of the modules in the run, given to the exports. The data of a module is loaded with the module's load
+    function when it is first used, after waiting for the module's export to finish (if it is run).
+    """
+
+    def __init__(
+        self,
+        config: PipelineConfig,
+        mods: dict[str, ModuleType],
+        futures: dict[str, Future],
+        run_report: report.RunReport | None = None,
+    ):
+        self.config = config
+        self.mods = mods
+        self.futures = futures
+        self.run_report = run_report
+        self.data: dict[str, object] = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, cmd: str) -> Any:
+        # raises the error of the export, if it failed
+        if cmd in self.futures:
+            self.futures[cmd].result()
+        with self.lock:
+            if cmd not in self.data:
+                mod = self.mods[cmd]
+                if not hasattr(mod, "load"):
+                    self.data[cmd] = None
+                elif self.run_report:
+                    with self.run_report.timed(cmd, "load"):
+                        self.data[cmd] = mod.load(self.config)
                 else:
-                    # add dependency so we don't have to look for the load method again
-                    module_data[dependency] = None
-        new_tasks = mod.export(config, module_data)
-
-        # callables added to entry_tasks will be called for each entry
-        entry_tasks.extend(new_tasks)
-
-    # for each entry, do the needed tasks
-    # TODO read_data actually loads the entire file, but here we should read one line at a time
-    for entry in read_data(config)[2]:
-        updated_entry = entry
-        for task in entry_tasks:
-            updated_entry = task(updated_entry)
+                    self.data[cmd] = mod.load(self.config)
+            return self.data[cmd]
+
+
+def _batch_task(task: Callable[[Entry], Entry]) -> Callable[[Sequence[Entry]], list[Entry]]:
+    def batch_task(entries: Sequence[Entry]) -> list[Entry]:
+        return [task(entry) for entry in entries]
+
+    return batch_task
@@ -0,0 +1,23 @@
+import os
+from pathlib import Path
+
+"""
+Data that is kept between runs and shared by all resources, in $XDG_CACHE_HOME/karp-pipeline (by default
+~/.cache/karp-pipeline), one directory for each kind of data.
+"""
+
+
+def get_cache_dir(name: str) -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    path = Path(cache_home) / "karp-pipeline" / name
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def write(path: Path, data: bytes) -> None:
+    """
+    Replaces the file in one step, so that other processes never read a partly written file
+    """
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_bytes(data)
+    tmp_path.replace(path)
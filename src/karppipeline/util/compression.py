@@ -0,0 +1,192 @@
+import bz2
+import gzip
+import io
+import lzma
+from pathlib import Path
+import queue
+import threading
+from typing import BinaryIO, Callable
+
+from karppipeline.common import ImportException
+
+"""
+Reading and writing of compressed files, detected by suffix. Decompression runs in a background thread that hands
+over the decompressed data through a bounded queue, so that decompression and parsing overlap (the
+decompressors release the GIL while working). Compression is done the same way in a background thread.
+"""
+
+# the size of the decompressed chunks handed over to the reader
+CHUNK_SIZE = 1024 * 1024
+# the max number of decompressed chunks waiting to be read
+MAX_CHUNKS = 16
+
+
+def _open_zstd(path: Path) -> BinaryIO:
+    try:
+        import zstandard
+    except ModuleNotFoundError as e:
+        raise ImportException(
+            f"the package zstandard must be installed to read {path}, install karp-pipeline[zstd]"
+        ) from e
+    # read_across_frames, since zstd files may consist of many frames, for example when written in parallel
+    return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True)
+
+
+_openers: dict[str, Callable[[Path], BinaryIO]] = {
+    ".gz": lambda path: gzip.open(path, "rb"),
+    ".bz2": lambda path: bz2.open(path, "rb"),
+    ".xz": lambda path: lzma.open(path, "rb"),
+    ".zst": _open_zstd,
+}
+
+
+def _create_zstd(path: Path) -> BinaryIO:
+    try:
+        import zstandard
+    except ModuleNotFoundError as e:
+        raise ImportException(
+            f"the package zstandard must be installed to write {path}, install karp-pipeline[zstd]"
+        ) from e
+    return zstandard.ZstdCompressor().stream_writer(open(path, "wb"), closefd=True)
+
+
+_creators: dict[str, Callable[[Path], BinaryIO]] = {
+    # level 6 is the default of the gzip command, much faster than the default of the gzip module
+    ".gz": lambda path: gzip.open(path, "wb", compresslevel=6),
+    ".zst": _create_zstd,
+}
+
+
+def is_compressed(path: Path) -> bool:
+    return path.suffix in _openers
+
+
+def content_suffix(path: Path) -> str:
+    """
+    The suffix of the file when decompressed, for example .jsonl for data.jsonl.gz
+    """
+    if is_compressed(path):
+        return Path(path.stem).suffix
+    return path.suffix
+
+
+def open_read(path: Path) -> BinaryIO:
+    """
+    Opens a compressed file for reading in binary mode, decompressed in a background thread
+    """
+    return io.BufferedReader(_ThreadedReader(lambda: _openers[path.suffix](path)), buffer_size=CHUNK_SIZE)
+
+
+def open_write(path: Path) -> BinaryIO:
+    """
+    Opens a file for writing in binary mode. Files ending with .gz or .zst are compressed in a background thread, the
+    data given to write is copied, so the caller may reuse its buffer.
+    """
+    if path.suffix not in _creators:
+        return open(path, "wb", buffering=CHUNK_SIZE)
+    return _ThreadedWriter(lambda: _creators[path.suffix](path))
+
+
+class _ThreadedWriter(io.RawIOBase):
+    def __init__(self, open_file: Callable[[], BinaryIO]):
+        self._queue: queue.Queue[bytes | None] = queue.Queue(maxsize=MAX_CHUNKS)
+        self._error: BaseException | None = None
+        self._failed = threading.Event()
+        self._thread = threading.Thread(target=self._consume, args=(open_file,), daemon=True)
+        self._thread.start()
+
+    def _consume(self, open_file: Callable[[], BinaryIO]) -> None:
+        try:
+            with open_file() as fp:
+                while (chunk := self._queue.get()) is not None:
+                    fp.write(chunk)
+        except BaseException as e:
+            self._error = e
+            self._failed.set()
+
+    def _put(self, item: bytes | None) -> None:
+        # wait for room in the queue, but give up if the compression has failed
+        while not self._failed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise self._error
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._put(bytes(data))
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                self._put(None)
+                self._thread.join()
+                if self._error:
+                    raise self._error
+            finally:
+                super().close()
+
+
+class _ThreadedReader(io.RawIOBase):
+    def __init__(self, open_file: Callable[[], BinaryIO]):
+        self._queue: queue.Queue[bytes | BaseException] = queue.Queue(maxsize=MAX_CHUNKS)
+        self._stopped = threading.Event()
+        self._chunk = memoryview(b"")
+        self._eof = False
+        # the error of the decompression, raised on every read after it
+        self._error: BaseException | None = None
+        self._thread = threading.Thread(target=self._produce, args=(open_file,), daemon=True)
+        self._thread.start()
+
+    def _produce(self, open_file: Callable[[], BinaryIO]) -> None:
+        try:
+            with open_file() as fp:
+                while not self._stopped.is_set():
+                    chunk = fp.read(CHUNK_SIZE)
+                    self._put(chunk)
+                    if not chunk:
+                        break
+        except BaseException as e:
+            self._put(e)
+
+    def _put(self, item: bytes | BaseException) -> None:
+        # wait for room in the queue, but give up if the reader is closed
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if not self._chunk:
+            if self._error:
+                raise self._error
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, BaseException):
+                self._error = item
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._chunk = memoryview(item)
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    def close(self) -> None:
+        if not self.closed:
+            self._stopped.set()
+            self._thread.join()
+        super().close()
@@ -18,5 +18,5 @@ def dumps(obj: object) -> str:
     ).decode()
 
 
-def loads(str: str) -> Map:
+def loads(str: str | bytes) -> Map:
     return orjson.loads(str)
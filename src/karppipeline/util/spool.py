@@ -0,0 +1,56 @@
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import orjson
+
+from karppipeline.models import Entry
+
+"""
+A spool is a local file with already parsed entries, one orjson-encoded entry per line. Newlines
+in values are always escaped by orjson, so the file can be split on newline without a real parser.
+"""
+
+
+def write(path: Path, entries: Iterable[Entry]) -> Iterator[Entry]:
+    """
+    Writes each entry to the spool while passing it on, the file is complete when the iterator is exhausted
+    """
+    with open(path, "wb", buffering=1024 * 1024) as fp:
+        for entry in entries:
+            fp.write(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE))
+            yield entry
+
+
+def read(path: Path, remove: bool = True) -> Iterator[Entry]:
+    """
+    Replays the entries in a spool, the file is removed when all entries has been read
+    """
+    with open(path, "rb", buffering=1024 * 1024) as fp:
+        for line in fp:
+            yield orjson.loads(line)
+    if remove:
+        path.unlink()
+
+
+def part_path(path: Path, part: int) -> Path:
+    """
+    Path for a part of a spool that is written in several parts, for example by different processes
+    """
+    return path.with_name(f"{path.stem}.{part:05}{path.suffix}")
+
+
+def _parts(path: Path) -> list[Path]:
+    return sorted(path.parent.glob(f"{path.stem}.*{path.suffix}"))
+
+
+def read_parts(path: Path) -> Iterator[Entry]:
+    """
+    Replays the entries of all the parts of a spool, in order
+    """
+    for part in _parts(path):
+        yield from read(part)
+
+
+def remove_parts(path: Path) -> None:
+    for part in _parts(path):
+        part.unlink()
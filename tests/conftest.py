@@ -0,0 +1,32 @@
+from typing import Callable
+
+import pytest
+
+from karppipeline.models import PipelineConfig
+from karppipeline.modules.karps.models import KarpsConfig
+
+
+@pytest.fixture
+def karps_configs(tmp_path) -> Callable[..., tuple[PipelineConfig, KarpsConfig]]:
+    """
+    Gives a function that creates the configs of a resource in tmp_path, with the given karps settings
+    """
+
+    def configs(**karps_settings) -> tuple[PipelineConfig, KarpsConfig]:
+        pipeline_config = PipelineConfig.model_validate(
+            {"resource_id": "test", "export": {}, "fields": [], "workdir": tmp_path}
+        )
+        karps_config = KarpsConfig.model_validate(
+            {
+                "output_config_dir": str(tmp_path / "karps"),
+                "db_database": "karps",
+                "db_user": "karps",
+                "db_password": "",
+                "entry_word": {"field": "word", "description": "word"},
+                "link": "",
+            }
+            | karps_settings
+        )
+        return pipeline_config, karps_config
+
+    return configs
@@ -0,0 +1,16 @@
+from karppipeline.cli import _parse_options
+
+
+def test_parse_options():
+    assert _parse_options(["karp-pipeline", "run"]) == (["karp-pipeline", "run"], 1, False, False)
+    assert _parse_options(["karp-pipeline", "--jobs", "4", "run", "karps"]) == (
+        ["karp-pipeline", "run", "karps"],
+        4,
+        False,
+        False,
+    )
+    assert _parse_options(["karp-pipeline", "install", "--jobs=2"]) == (["karp-pipeline", "install"], 2, False, False)
+    assert _parse_options(["karp-pipeline", "run", "--force"]) == (["karp-pipeline", "run"], 1, True, False)
+    assert _parse_options(["karp-pipeline", "run", "--profile"]) == (["karp-pipeline", "run"], 1, False, True)
+    assert _parse_options(["karp-pipeline", "run", "--jobs"]) is None
+    assert _parse_options(["karp-pipeline", "run", "--jobs=0"]) is None
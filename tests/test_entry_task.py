@@ -0,0 +1,102 @@
+import pytest
+
+from karppipeline.converters import memoize
+from karppipeline.models import EntrySchema, InferredField, PipelineConfig
+from karppipeline.modules.schema.entry_task import _clean_text, get_entry_converter
+
+
+def _schema() -> EntrySchema:
+    return {
+        "word": InferredField(name="word", type="text", extra={"length": 10}),
+        "pos": InferredField(name="pos", type="text", extra={"length": 2}),
+        "tags": InferredField(name="tags", type="text", collection=True, extra={"length": 10}),
+        "freq": InferredField(name="freq", type="integer"),
+    }
+
+
+def _converter(*fields: str):
+    config = PipelineConfig.model_validate(
+        {"resource_id": "test", "export": {"fields": list(fields)}, "fields": [], "workdir": "."}
+    )
+    entry_schema = _schema()
+    return get_entry_converter(config, entry_schema), entry_schema
+
+
+def test_copy_in_schema_order_and_clean():
+    convert, _ = _converter()
+    entry = {"freq": 3, "tags": ["a b", "c\u200bd"], "word": "x\ty\nz"}
+    new_entry = convert(entry)
+    assert new_entry == {"word": "xy\nz", "tags": ["a b", "cd"], "freq": 3}
+    assert list(new_entry) == ["word", "tags", "freq"]
+    assert convert({"word": "w", "tags": None}) == {"word": "w", "tags": []}
+
+
+def test_rename_convert_and_exclude():
+    convert, entry_schema = _converter("...", "pos:ud.saldo_to_ud as upos", "pos as orig_pos", "not freq")
+    assert list(entry_schema) == ["word", "pos", "tags", "upos", "orig_pos"]
+    new_entry = convert({"word": "w", "pos": "nn", "freq": 1})
+    assert new_entry == {"word": "w", "pos": "nn", "upos": "NOUN", "orig_pos": "nn"}
+    assert list(new_entry) == ["word", "pos", "upos", "orig_pos"]
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("plain", "plain"),
+        ("a\tb\r\nc\x7f", "ab\nc"),
+        ("röd\u00a0bil\u00ad", "röd bil"),
+        ("kär\u200blek\u3000\U000e0001\U0001f600", "kärlek \U0001f600"),
+        ("\u0378\U0010ffff", ""),
+    ],
+)
+def test_clean_text(text, expected):
+    assert _clean_text(text) == expected
+
+
+def test_memoized_converter():
+    calls = []
+
+    def convert(resource_id, value):
+        calls.append(value)
+        return f"{resource_id}:{value}"
+
+    convert_value = memoize(convert, "test", maxsize=2)
+    assert [convert_value(v) for v in ["a", "a", "b", "a"]] == ["test:a", "test:a", "test:b", "test:a"]
+    assert convert_value(["c"]) == convert_value(["c"]) == "test:['c']"
+    assert calls == ["a", "b", ["c"], ["c"]]
+    info = convert_value.cache_info()
+    assert (info.hits, info.misses) == (2, 2)
+    # equal values of different types are not mixed up
+    assert [convert_value(v) for v in [1, 1.0, True]] == ["test:1", "test:1.0", "test:True"]
+
+    config = PipelineConfig.model_validate(
+        {
+            "resource_id": "test",
+            "export": {"fields": ["...", "pos:ud.saldo_to_ud as upos"]},
+            "fields": [],
+            "workdir": ".",
+        }
+    )
+    entry_converter = get_entry_converter(config, _schema(), converter_cache_size=10)
+    assert [entry_converter({"pos": pos})["upos"] for pos in ["nn", "nn", "vb"]] == ["NOUN", "NOUN", "VERB"]
+    assert entry_converter.memoized["ud.saldo_to_ud"].cache_info().hits == 1
+    # the cache is also used in batches, although the converter has a batch function
+    converted = entry_converter.batch([{"pos": pos} for pos in ["nn", "vb", "ab", "nn"]])
+    assert [entry["upos"] for entry in converted] == ["NOUN", "VERB", "ADV", "NOUN"]
+    assert entry_converter.memoized["ud.saldo_to_ud"].cache_info().hits == 4
+
+
+def test_batch_same_as_per_entry():
+    convert, _ = _converter(
+        "...", "pos:ud.saldo_to_ud as upos", "pos:ud.saldo_to_suc as word", "word as orig", "not freq"
+    )
+    entries = [
+        {"word": "a\u200b", "pos": "nn", "tags": ["x\u00a0y"], "freq": 1},
+        {"word": "b", "pos": "vbm", "tags": None},
+        {"pos": "ab", "word": "c"},
+    ]
+    converted = convert.batch(entries)
+    assert converted == [convert(entry) for entry in entries]
+    assert [list(entry) for entry in converted] == [list(convert(entry)) for entry in entries]
+    # the converters are timed per batch
+    assert convert.timings["ud.saldo_to_ud"][0] == convert.timings["ud.saldo_to_suc"][0] == 3
@@ -0,0 +1,32 @@
+import pytest
+
+from karppipeline.models import PipelineConfig
+from karppipeline.modules import jsonl
+from karppipeline.util import compression, json
+
+
+@pytest.mark.parametrize("compression_suffix", [None, "gz", "zst"])
+def test_export(tmp_path, monkeypatch, compression_suffix):
+    monkeypatch.setattr(jsonl, "BUFFER_SIZE", 100)
+    config = PipelineConfig.model_validate(
+        {
+            "resource_id": "test",
+            "export": {},
+            "fields": [],
+            "workdir": tmp_path,
+            "jsonl": {"compression": compression_suffix},
+        }
+    )
+    (tmp_path / "output").mkdir()
+    # output from an earlier run with other settings
+    (tmp_path / "output" / "test.jsonl.zst").touch()
+    (tmp_path / "output" / "test.jsonl").touch()
+    entries = [{"word": f"w{i}", "n": i, "tags": ["å"]} for i in range(50)] + [{}]
+    [task] = jsonl.export(config, {})
+    task.batch(entries)
+    task.close()
+
+    path = jsonl.get_output_path(config)
+    assert [path.name] == [path.name for path in (tmp_path / "output").iterdir()]
+    with compression.open_read(path) if compression_suffix else open(path, "rb") as fp:
+        assert [json.loads(line) for line in fp] == entries
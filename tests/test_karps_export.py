@@ -0,0 +1,135 @@
+import pytest
+
+from karppipeline.common import GeneratorTask, ImportException
+from karppipeline.models import Entry, EntrySchema, InferredField
+from karppipeline.modules.karps import manifest
+from karppipeline.modules.karps.export import (
+    create_karps_sql,
+    get_data_dir,
+    get_generation_path,
+    get_schema_sql_path,
+    get_sql_path,
+)
+from karppipeline.util import json
+
+
+def _schema() -> EntrySchema:
+    return {
+        "word": InferredField(name="word", type="text", extra={"length": 10}),
+        "tags": InferredField(name="tags", type="text", collection=True, extra={"length": 10}),
+    }
+
+
+def _create_sql(karps_configs, entries: list[Entry], **karps_settings) -> list[str]:
+    pipeline_config, karps_config = karps_configs(**karps_settings)
+    (pipeline_config.workdir / "output").mkdir(exist_ok=True)
+    task = GeneratorTask(create_karps_sql(pipeline_config, karps_config, _schema()))
+    for entry in entries:
+        task(entry)
+    task.close()
+    sql_path = get_sql_path(pipeline_config)
+    if not sql_path.exists():
+        return []
+    with open(sql_path) as fp:
+        return [line.strip() for line in fp if line.startswith(("INSERT", "UPDATE", "DELETE"))]
+
+
+def test_incremental(karps_configs):
+    entries: list[Entry] = [{"word": "a", "tags": ["x"]}, {"word": "b"}, {"word": "c"}]
+    statements = _create_sql(karps_configs, entries, key="word", incremental=True)
+    assert statements == [
+        "INSERT INTO `test$a` (`__id`, `word`) VALUES (0, 'a'), (1, 'b'), (2, 'c');",
+        "INSERT INTO `test__tags$a` (`__parent_id`, `tags`) VALUES (0, 'x');",
+    ]
+
+    # nothing installed yet, so a new run creates SQL for all entries again, for tables with the other suffix
+    rerun = _create_sql(karps_configs, entries, key="word", incremental=True)
+    assert rerun == [statement.replace("$a", "$b") for statement in statements]
+
+    pipeline_config, _ = karps_configs()
+    manifest.get_manifest_path(pipeline_config).replace(manifest.get_installed_manifest_path(pipeline_config))
+    changed_entries: list[Entry] = [{"word": "a", "tags": ["y"]}, {"word": "c"}, {"word": "d"}]
+    assert get_generation_path(pipeline_config).exists()
+    assert _create_sql(karps_configs, changed_entries, key="word", incremental=True) == [
+        "DELETE FROM `test__tags` WHERE __parent_id = 0;",
+        "UPDATE `test` SET `word` = 'a' WHERE __id = 0;",
+        "INSERT INTO `test` (`__id`, `word`) VALUES (3, 'd');",
+        "INSERT INTO `test__tags` (`__parent_id`, `tags`) VALUES (0, 'y');",
+        "DELETE FROM `test__tags` WHERE __parent_id = 1;",
+        "DELETE FROM `test` WHERE __id = 1;",
+    ]
+    # the changes are made to the tables in use
+    assert not get_generation_path(pipeline_config).exists()
+
+
+def test_insert_batches(karps_configs):
+    entries: list[Entry] = [{"word": f"w{i}", "tags": ["x", "y"]} for i in range(5)] + [{"tags": ["z'"]}]
+    statements = _create_sql(karps_configs, entries, insert_batch_size=2, insert_max_bytes=10_000)
+    # the rows in test__tags refer to the rows in test, so these are always written first
+    assert statements == [
+        "INSERT INTO `test$a` (`__id`, `word`) VALUES (0, 'w0'), (1, 'w1');",
+        "INSERT INTO `test__tags$a` (`__parent_id`, `tags`) VALUES (0, 'x'), (0, 'y');",
+        "INSERT INTO `test$a` (`__id`, `word`) VALUES (2, 'w2');",
+        "INSERT INTO `test__tags$a` (`__parent_id`, `tags`) VALUES (1, 'x'), (1, 'y');",
+        "INSERT INTO `test$a` (`__id`, `word`) VALUES (3, 'w3');",
+        "INSERT INTO `test__tags$a` (`__parent_id`, `tags`) VALUES (2, 'x'), (2, 'y');",
+        "INSERT INTO `test$a` (`__id`, `word`) VALUES (4, 'w4');",
+        "INSERT INTO `test__tags$a` (`__parent_id`, `tags`) VALUES (3, 'x'), (3, 'y');",
+        "INSERT INTO `test$a` (`__id`, `word`) VALUES (5, NULL);",
+        "INSERT INTO `test__tags$a` (`__parent_id`, `tags`) VALUES (4, 'x'), (4, 'y');",
+        "INSERT INTO `test__tags$a` (`__parent_id`, `tags`) VALUES (5, 'z\\'');",
+    ]
+
+    statements = _create_sql(karps_configs, entries, insert_max_bytes=100)
+    assert all(len(statement) <= 100 for statement in statements)
+
+
+def test_bulk_load_files(karps_configs):
+    entries: list[Entry] = [{"word": "a\tb\\c\nd'", "tags": ["x", "y"]}, {"tags": []}]
+    assert _create_sql(karps_configs, entries, bulk_load=True) == []
+    pipeline_config, _ = karps_configs()
+    assert not get_sql_path(pipeline_config).exists()
+    assert "CREATE TABLE `test$a`" in get_schema_sql_path(pipeline_config).read_text()
+    data_dir = get_data_dir(pipeline_config)
+    assert (data_dir / "test$a.tsv").read_text() == "__id\tword\n0\ta\\tb\\\\c\\nd'\n1\t\\N\n"
+    assert (data_dir / "test__tags$a.tsv").read_text() == "__parent_id\ttags\n0\tx\n0\ty\n"
+
+    # without bulk_load the data files are removed
+    _create_sql(karps_configs, entries)
+    assert not data_dir.exists() and not get_schema_sql_path(pipeline_config).exists()
+
+
+def test_indexes_after_data(tmp_path, karps_configs):
+    _create_sql(karps_configs, [{"word": "a", "tags": ["x"]}])
+    with open(tmp_path / "output" / "test.sql") as fp:
+        statements = [line.strip() for line in fp if line.startswith(("INSERT", "ALTER", "CREATE INDEX"))]
+    assert statements[2:] == [
+        "ALTER TABLE `test$a` ADD INDEX `test__word_idx`(`word`(10));",
+        "ALTER TABLE `test__tags$a` ADD INDEX `test__tags_tags_idx`(`tags`(10));",
+    ]
+
+
+def test_generation(karps_configs):
+    _create_sql(karps_configs, [{"word": "a", "tags": ["x"]}])
+    pipeline_config, _ = karps_configs()
+    generation = json.loads(get_generation_path(pipeline_config).read_text())
+    assert generation == {"suffix": "$a", "tables": ["test", "test__tags"]}
+    sql = get_sql_path(pipeline_config).read_text()
+    # only the new tables are created, install removes the old ones
+    assert "DROP" not in sql
+    assert "CREATE TABLE `test__tags$a`" in sql and "REFERENCES `test$a`(__id)" in sql
+    # the next full export alternates the suffix
+    _create_sql(karps_configs, [{"word": "a"}])
+    assert json.loads(get_generation_path(pipeline_config).read_text())["suffix"] == "$b"
+    _create_sql(karps_configs, [{"word": "a"}])
+    assert json.loads(get_generation_path(pipeline_config).read_text())["suffix"] == "$a"
+
+
+def test_table_name_length(karps_configs):
+    pipeline_config, karps_config = karps_configs()
+    (pipeline_config.workdir / "output").mkdir()
+    # the main table fits with the suffix, the collection table doesn't
+    pipeline_config = pipeline_config.model_copy(update={"resource_id": "r" * 57})
+    with pytest.raises(ImportException, match=f"{'r' * 57}__tags[$]a is 65 characters"):
+        GeneratorTask(create_karps_sql(pipeline_config, karps_config, _schema())).close()
+    GeneratorTask(create_karps_sql(pipeline_config, karps_config, {"word": _schema()["word"]})).close()
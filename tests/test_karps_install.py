@@ -0,0 +1,211 @@
+import importlib
+import threading
+
+from pydantic import ValidationError
+import pytest
+
+from karppipeline.common import GeneratorTask, InstallException
+from karppipeline.models import Entry, InferredField, PipelineConfig
+from karppipeline.modules.karps import manifest
+from karppipeline.modules.karps.export import create_karps_sql, get_data_dir, get_generation_path, get_sql_path
+from karppipeline.modules.karps.install import _split_statements
+from karppipeline.modules.karps.models import KarpsConfig
+from karppipeline.util import json
+
+# the karps package has an install function, which hides the module
+install = importlib.import_module("karppipeline.modules.karps.install")
+
+
+class _FakeDatabase:
+    """
+    Records what is sent to the database, from all connections
+    """
+
+    def __init__(self, tables: list[str]):
+        self.tables = tables
+        self.log: list[str] = []
+        self.lock = threading.Lock()
+        self.pool_settings: dict[str, object] = {}
+
+    def pool(self, **settings) -> "_FakePool":
+        self.pool_settings = settings
+        return _FakePool(self)
+
+
+class _FakePool:
+    def __init__(self, database: _FakeDatabase):
+        self.database = database
+
+    def get_connection(self) -> "_FakeConnection":
+        return _FakeConnection(self.database)
+
+
+class _FakeConnection:
+    def __init__(self, database: _FakeDatabase):
+        self.database = database
+
+    def cursor(self) -> "_FakeCursor":
+        return _FakeCursor(self.database)
+
+    def commit(self) -> None:
+        with self.database.lock:
+            self.database.log.append("COMMIT")
+
+    def close(self) -> None:
+        pass
+
+
+class _FakeCursor:
+    def __init__(self, database: _FakeDatabase):
+        self.database = database
+
+    def __enter__(self) -> "_FakeCursor":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def execute(self, sql: str, params: tuple | None = None) -> None:
+        with self.database.lock:
+            self.database.log.append(sql)
+
+    def fetchsets(self):
+        yield from ()
+
+    def fetchall(self) -> list[tuple[str]]:
+        return [(table,) for table in self.database.tables]
+
+
+@pytest.fixture
+def database(monkeypatch) -> _FakeDatabase:
+    database = _FakeDatabase(["test", "test__tags"])
+    monkeypatch.setattr(install, "MySQLConnectionPool", database.pool)
+    return database
+
+
+def _export(karps_configs, entries: list[Entry], **karps_settings) -> tuple[PipelineConfig, KarpsConfig]:
+    pipeline_config, karps_config = karps_configs(**karps_settings)
+    (pipeline_config.workdir / "output").mkdir(exist_ok=True)
+    entry_schema = {
+        "word": InferredField(name="word", type="text", extra={"length": 10}),
+        "tags": InferredField(name="tags", type="text", collection=True, extra={"length": 10}),
+        "forms": InferredField(name="forms", type="text", collection=True, extra={"length": 10}),
+    }
+    task = GeneratorTask(create_karps_sql(pipeline_config, karps_config, entry_schema))
+    for entry in entries:
+        task(entry)
+    task.close()
+    return pipeline_config, karps_config
+
+
+def _install(pipeline_config: PipelineConfig, karps_config: KarpsConfig) -> None:
+    install.add_to_db(pipeline_config, karps_config)
+    install.update_installed_manifest(pipeline_config)
+
+
+def test_install_after_incremental(karps_configs, database):
+    entries: list[Entry] = [{"word": "a", "tags": ["x"]}, {"word": "b"}]
+    _install(*_export(karps_configs, entries, key="word", incremental=True))
+    configs = _export(karps_configs, entries + [{"word": "c"}], key="word", incremental=True)
+    assert not get_generation_path(configs[0]).exists()
+    _install(*configs)
+    # the changes can only be installed once
+    with pytest.raises(InstallException, match="already installed"):
+        _install(*configs)
+
+    # a full export without key can be installed after the changes, and the next incremental run is a full export
+    _install(*_export(karps_configs, entries))
+    assert not manifest.get_installed_manifest_path(configs[0]).exists()
+    _export(karps_configs, entries, key="word", incremental=True)
+    assert get_generation_path(configs[0]).exists()
+    assert any(statement.startswith("RENAME TABLE") for statement in database.log)
+
+
+def test_install_incremental_commit(karps_configs, database):
+    entries: list[Entry] = [{"word": f"w{i}", "tags": ["x"]} for i in range(50)]
+    settings = {"key": "word", "incremental": True, "install_batch_bytes": 200, "install_commit_bytes": 400}
+    _install(*_export(karps_configs, entries, **settings))
+    assert database.log.count("COMMIT") > 2
+    database.log.clear()
+    # the changes to the tables in use are committed together, a failed install leaves them as they were
+    _install(*_export(karps_configs, [{**entry, "tags": ["y"]} for entry in entries], **settings))
+    assert len([sql for sql in database.log if sql.startswith(("DELETE", "INSERT", "UPDATE"))]) > 2
+    assert database.log.count("COMMIT") == 1 and database.log[-1] == "COMMIT"
+
+
+def test_reinstall_full_export(karps_configs, database):
+    entries: list[Entry] = [{"word": "a", "tags": ["x"]}, {"word": "b"}]
+    configs = _export(karps_configs, entries, key="word")
+    # the new tables can be installed again, and the installed manifest still describes them
+    _install(*configs)
+    _install(*configs)
+    assert manifest.get_installed_manifest_path(configs[0]).exists()
+    _export(karps_configs, entries + [{"word": "c"}], key="word", incremental=True)
+    assert not get_generation_path(configs[0]).exists()
+    with open(get_sql_path(configs[0])) as fp:
+        assert list(_split_statements(fp)) == ["INSERT INTO `test` (`__id`, `word`) VALUES (2, 'c')"]
+
+
+def test_install_batches(karps_configs, database):
+    entries: list[Entry] = [{"word": f"w{i}", "tags": ["x", "y"]} for i in range(100)]
+    pipeline_config, karps_config = _export(
+        karps_configs, entries, insert_batch_size=10, install_batch_bytes=1000, install_commit_bytes=3000
+    )
+    install.add_to_db(pipeline_config, karps_config)
+    assert database.pool_settings["pool_size"] == 1
+    assert database.log[0].startswith("SET SESSION foreign_key_checks = 0")
+
+    with open(get_sql_path(pipeline_config)) as fp:
+        statements = list(_split_statements(fp))
+    batches = [sql for sql in database.log if sql.startswith(("CREATE", "INSERT", "ALTER"))]
+    # the statements are sent in order, in batches of at most install_batch_bytes
+    assert [statement for batch in batches for statement in batch.split(";\n")] == statements
+    assert len(batches) > 1
+    assert all(len(batch.encode()) <= 1000 for batch in batches)
+    # commits after each install_commit_bytes, and at the end, before the tables are swapped on a new connection
+    sessions = [i for i, sql in enumerate(database.log) if sql.startswith("SET SESSION")]
+    assert len(sessions) == 2
+    assert database.log[: sessions[1]].count("COMMIT") > 1
+    assert database.log[sessions[1] - 1] == "COMMIT"
+    assert database.log[sessions[1] + 2].startswith("RENAME TABLE")
+
+
+def test_install_data_files(karps_configs, database):
+    entries: list[Entry] = [{"word": f"w{i}", "tags": ["x"], "forms": ["f"]} for i in range(10)]
+    pipeline_config, karps_config = _export(karps_configs, entries, bulk_load=True, install_workers=2)
+    install.add_to_db(pipeline_config, karps_config)
+    assert database.pool_settings["pool_size"] == 3
+    assert database.pool_settings["allow_local_infile_in_path"] == str(get_data_dir(pipeline_config))
+
+    suffix = json.loads(get_generation_path(pipeline_config).read_bytes())["suffix"]
+    loads = [i for i, sql in enumerate(database.log) if sql.startswith("LOAD DATA")]
+    tables = [database.log[i].split("INTO TABLE ")[1].split()[0] for i in loads]
+    # the main table is loaded and committed first, then the other tables in parallel
+    assert tables[0] == f"`test{suffix}`"
+    assert database.log[loads[0] + 1] == "COMMIT"
+    assert sorted(tables[1:]) == [f"`test__forms{suffix}`", f"`test__tags{suffix}`"]
+
+
+def test_install_workers_limit(karps_configs):
+    assert karps_configs(install_workers=31)[1].install_workers == 31
+    with pytest.raises(ValidationError):
+        karps_configs(install_workers=32)
+
+
+def test_split_statements():
+    sql = """
+    -- a comment; with a delimiter
+    CREATE TABLE `a;b` (x INT); # another comment
+    INSERT INTO t VALUES ('ends with;
+', 'it\\'s; "quoted"'), ("x;", 1-1, 2--1);
+    /* block; comment */ SELECT 1 /* inline */;;
+    SELECT 'multi
+line;
+value'
+    """
+    assert list(_split_statements(sql.splitlines(keepends=True))) == [
+        "CREATE TABLE `a;b` (x INT)",
+        "INSERT INTO t VALUES ('ends with;\n', 'it\\'s; \"quoted\"'), (\"x;\", 1-1, 2--1)",
+        "/* block; comment */ SELECT 1 /* inline */",
+        "SELECT 'multi\nline;\nvalue'",
+    ]
@@ -0,0 +1,126 @@
+import gzip
+import random
+
+import pytest
+
+from karppipeline.common import ImportException
+from karppipeline.models import PipelineConfig
+from karppipeline.read import (
+    SourceOrderTracker,
+    _read_json_lines,
+    can_split_source,
+    get_column_types,
+    read_data,
+)
+from karppipeline.util import compression, json
+
+
+def _merge_source_order(source_order: list[str], new_keys: list[str]) -> list[str]:
+    """
+    The list splicing version of SourceOrderTracker.update, the tracker must give the same result
+    """
+    source_place = 0
+    for i, key in enumerate(new_keys):
+        if key in source_order:
+            source_place = source_order.index(key)
+            continue
+        source_order_from_current = source_order[source_place:]
+        for future_key in new_keys[i:]:
+            if future_key in source_order_from_current:
+                anchor_idx = source_order.index(future_key)
+                source_order.insert(anchor_idx, key)
+                source_place = anchor_idx
+                break
+        else:
+            source_order.append(key)
+    return source_order
+
+
+def test_source_order():
+    tracker = SourceOrderTracker()
+    for keys in [("a", "c"), ("a", "b", "c"), ("a", "c", "d"), ("e", "a"), ("a", "b", "c")]:
+        tracker.update(keys)
+    assert tracker.order == ["e", "a", "b", "c", "d"]
+
+
+def test_source_order_same_as_splicing():
+    rng = random.Random(0)
+    keys = [f"key{i}" for i in range(15)]
+    for _ in range(200):
+        tracker = SourceOrderTracker()
+        expected: list[str] = []
+        for _ in range(rng.randint(1, 20)):
+            layout = rng.sample(keys, rng.randint(1, len(keys)))
+            # repeated layouts are common in real data
+            for _ in range(rng.randint(1, 3)):
+                tracker.update(tuple(layout))
+                _merge_source_order(expected, layout)
+        assert tracker.order == expected
+
+
+def _csv_config(tmp_path, content: str, csv_settings: dict[str, object]) -> PipelineConfig:
+    (tmp_path / "source").mkdir()
+    (tmp_path / "source" / "data.csv").write_text(content)
+    return PipelineConfig.model_validate(
+        {"resource_id": "test", "export": {}, "fields": [], "import": {"csv": csv_settings}, "workdir": tmp_path}
+    )
+
+
+def test_csv_cast_and_empty_values(tmp_path):
+    config = _csv_config(tmp_path, "word,freq\na,1\nb,\n", {"cast_fields": [{"name": "freq", "type": "int"}]})
+    assert list(read_data(config)[2]) == [{"word": "a", "freq": 1}, {"word": "b", "freq": None}]
+
+
+def test_csv_unknown_type(tmp_path):
+    config = _csv_config(tmp_path, "word,freq\na,1\n", {"cast_fields": [{"name": "freq", "type": "date"}]})
+    with pytest.raises(ImportException):
+        read_data(config)
+
+
+def test_csv_infer_types(tmp_path):
+    config = _csv_config(tmp_path, "word,freq,score,id\na,1,0.5,007\nb,,2,1\n", {"infer_types": True})
+    assert get_column_types(config) == {"freq": "int", "score": "float"}
+    assert list(read_data(config)[2])[1] == {"word": "b", "freq": None, "score": 2.0, "id": "1"}
+
+
+def test_compressed_source(tmp_path):
+    (tmp_path / "source").mkdir()
+    lines = [{"word": f"w{i}"} for i in range(1000)]
+    with gzip.open(tmp_path / "source" / "data.jsonl.gz", "wt") as fp:
+        fp.writelines(json.dumps(line) + "\n" for line in lines)
+    config = PipelineConfig.model_validate({"resource_id": "test", "export": {}, "fields": [], "workdir": tmp_path})
+    assert list(read_data(config)[2]) == lines
+    assert not can_split_source(config)
+
+
+def test_compressed_source_error(tmp_path):
+    path = tmp_path / "data.jsonl.gz"
+    path.write_bytes(gzip.compress(b"x" * 100000)[:-100])
+    with compression.open_read(path) as fp:
+        # the error is raised again when reading is retried, instead of waiting for more data
+        for _ in range(2):
+            with pytest.raises(EOFError):
+                fp.read()
+
+
+@pytest.mark.parametrize("block_size", [1, 3, 8, 1000])
+def test_read_json_lines_blocks(tmp_path, monkeypatch, block_size):
+    monkeypatch.setattr("karppipeline.read._BLOCK_SIZE", block_size)
+    # the last line has no newline
+    lines = [b"a", b"", b"bcdefghij", b"kl", b"mnopqrstuvwxyz", b"last"]
+    data = b"\n".join(lines)
+    path = tmp_path / "data.jsonl"
+    path.write_bytes(data)
+    assert list(_read_json_lines(path)) == lines
+    starts = [0]
+    for line in lines[:-1]:
+        starts.append(starts[-1] + len(line) + 1)
+    # a range starts at a line and gives the lines that start before its end, also if the end is within a line
+    for start in starts:
+        for end in range(start, len(data) + 2):
+            expected = [line for line, line_start in zip(lines, starts) if start <= line_start < end]
+            assert list(_read_json_lines(path, start, end)) == expected, (start, end)
+
+    compressed_path = tmp_path / "data.jsonl.gz"
+    compressed_path.write_bytes(gzip.compress(data))
+    assert list(_read_json_lines(compressed_path)) == lines
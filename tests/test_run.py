@@ -0,0 +1,227 @@
+import itertools
+import sys
+import threading
+from types import ModuleType
+
+import pstats
+import pytest
+
+from karppipeline.models import PipelineConfig
+from karppipeline.util import json
+from karppipeline.run import _run_stages, run
+
+
+def _module(monkeypatch, name: str, export, dependencies=(), **attrs) -> None:
+    mod = ModuleType(name)
+    mod.dependencies = list(dependencies)
+    mod.export = export
+    for key, value in attrs.items():
+        setattr(mod, key, value)
+    monkeypatch.setitem(sys.modules, "karppipeline.modules." + name, mod)
+
+
+def test_concurrent_exports(monkeypatch, tmp_path):
+    config = PipelineConfig.model_validate({"resource_id": "test", "export": {}, "fields": [], "workdir": tmp_path})
+    fetched = threading.Event()
+    calls = []
+
+    def slow_export(config, module_data):
+        # only finishes if the exports that do not depend on it run at the same time
+        assert fetched.wait(timeout=5)
+        return [lambda entry: calls.append(("slow", entry)) or entry]
+
+    def infer_export(config, module_data):
+        fetched.set()
+        return [lambda entry: calls.append(("infer", entry)) or entry]
+
+    def output_export(config, module_data):
+        assert module_data["infer"] == {"size": 2}
+        assert module_data["slow"] is None
+        return [lambda entry: calls.append(("output", entry)) or entry]
+
+    _module(monkeypatch, "slow", slow_export)
+    _module(
+        monkeypatch,
+        "infer",
+        infer_export,
+        soft_dependencies=["slow"],
+        load=lambda config: {"size": 2},
+        entries=lambda config: iter([1, 2]),
+    )
+    _module(monkeypatch, "output", output_export, dependencies=["infer", "slow"])
+
+    run(config, "output")
+    # the entry tasks are called in dependency order
+    assert calls == [("slow", 1), ("slow", 2), ("infer", 1), ("infer", 2), ("output", 1), ("output", 2)]
+
+
+def test_report(monkeypatch, tmp_path):
+    config = PipelineConfig.model_validate({"resource_id": "test", "export": {}, "fields": [], "workdir": tmp_path})
+    _module(monkeypatch, "infer", lambda config, _: [], load=lambda config: {}, entries=lambda config: iter(range(5)))
+    _module(monkeypatch, "output", lambda config, _: [lambda entry: entry, _Sink()], dependencies=["infer"])
+
+    run(config, "output", profile=True)
+    report = json.loads((tmp_path / "log" / "report.json").read_bytes())
+    assert set(report["modules"]) == {"infer", "output"}
+    assert set(report["modules"]["infer"]) == {"export", "load"}
+    assert {name: task["entries"] for name, task in report["tasks"].items()} == {"output[0]": 5, "output[1]": 5}
+    assert report["passes"]["entries"]["entries"] == 5
+    assert report["peak_rss"] > 0
+    # the stage threads are profiled too
+    stats = pstats.Stats(str(tmp_path / "log" / "profile.prof"))
+    assert any(func[2] == "run_stage" for func in stats.stats)
+
+
+class _Sink:
+    sink = True
+
+    def __init__(self, fail_at: int | None = None):
+        self.entries = []
+        self.fail_at = fail_at
+        self.closed = False
+
+    def __call__(self, entry):
+        if entry == self.fail_at:
+            raise ValueError("sink failed")
+        self.entries.append(entry)
+        return entry
+
+    def close(self):
+        self.closed = True
+
+
+def test_stages(monkeypatch):
+    monkeypatch.setattr("karppipeline.run.BATCH_SIZE", 3)
+    first, second = _Sink(), _Sink()
+    _run_stages(range(10), [lambda entry: entry * 2, first, lambda entry: entry + 1, second])
+    # the sinks get the output of the tasks before them, in order
+    assert first.entries == [entry * 2 for entry in range(10)]
+    assert second.entries == [entry * 2 + 1 for entry in range(10)]
+    assert first.closed and second.closed
+
+    # a failing sink stops the pipeline, even if the source never ends
+    failing, other = _Sink(fail_at=50), _Sink()
+    with pytest.raises(ValueError, match="sink failed"):
+        _run_stages(itertools.count(), [failing, other])
+    assert not failing.closed and not other.closed
+
+
+def test_skip_up_to_date(monkeypatch, tmp_path):
+    exported = []
+
+    def export(name):
+        return lambda config, module_data: exported.append(name) or []
+
+    # the metadata is fetched by the export of first, external_inputs only reads what was fetched
+    metadata, cache = ["description"], {}
+
+    def export_first(config, module_data):
+        if metadata[0] is not None:
+            cache["body"] = metadata[0]
+        return export("first")(config, module_data)
+
+    _module(
+        monkeypatch,
+        "first",
+        export_first,
+        modifies_entries=True,
+        entries=lambda config: iter([]),
+        external_inputs=lambda config: cache.get("body"),
+    )
+    _module(monkeypatch, "second", export("second"), dependencies=["first"])
+    _module(monkeypatch, "other", export("other"))
+
+    def run_all(settings=None, **kwargs):
+        exported.clear()
+        config = PipelineConfig.model_validate(
+            {"resource_id": "test", "export": {"default": ["second", "other"]}, "fields": [], "workdir": tmp_path}
+            | (settings or {})
+        )
+        return run(config, **kwargs)
+
+    # the exports run concurrently, so the order varies
+    assert run_all() and sorted(exported) == ["first", "other", "second"]
+    assert not run_all() and exported == []
+    assert run_all(force=True) and sorted(exported) == ["first", "other", "second"]
+    # only the changed module runs, and the module that modifies its entries
+    assert run_all({"second": {"setting": 1}}) and sorted(exported) == ["first", "second"]
+    assert run_all({"second": {"setting": 1}, "first": {"setting": 1}}) and sorted(exported) == ["first", "second"]
+    # a change of the external inputs of a module also runs the modules that depend on it
+    settings = {"second": {"setting": 1}, "first": {"setting": 1}}
+    assert not run_all(settings)
+    metadata[0] = "new description"
+    cache.clear()
+    assert run_all(settings) and sorted(exported) == ["first", "second"]
+    assert not run_all(settings)
+    # while the metadata can't be fetched, the module and the modules that depend on it run every time
+    metadata[0] = None
+    cache.clear()
+    assert run_all(settings) and sorted(exported) == ["first", "second"]
+    assert run_all(settings) and sorted(exported) == ["first", "second"]
+
+
+def test_entry_modifiers(monkeypatch, tmp_path):
+    exported, tasks = [], []
+
+    def export(name, has_tasks=True):
+        return lambda config, module_data: (
+            exported.append(name) or ([lambda entry: tasks.append(entry) or entry] if has_tasks else [])
+        )
+
+    def read_source(config):
+        raise AssertionError("the entries are read without entry tasks")
+
+    _module(monkeypatch, "converter", export("converter"), modifies_entries=True, entries=lambda config: iter([1]))
+    _module(monkeypatch, "dump", export("dump"), dependencies=["converter"])
+    _module(monkeypatch, "upload", export("upload", False), dependencies=["dump"], has_entry_tasks=False)
+    _module(monkeypatch, "describe", export("describe", False), dependencies=["converter"], has_entry_tasks=False)
+    _module(monkeypatch, "index", export("index"), dependencies=["dump"])
+    monkeypatch.setattr("karppipeline.run.read_data", read_source)
+
+    def run_all(settings=None):
+        exported.clear()
+        tasks.clear()
+        config = PipelineConfig.model_validate(
+            {"resource_id": "test", "export": {"default": ["upload", "describe", "index"]}, "fields": []}
+            | {"workdir": tmp_path}
+            | (settings or {})
+        )
+        return run(config)
+
+    assert run_all() and sorted(exported) == ["converter", "describe", "dump", "index", "upload"]
+    # the modules without entry tasks run alone, and the entries are not read
+    assert run_all({"upload": {"setting": 1}}) and exported == ["upload"] and tasks == []
+    settings = {"upload": {"setting": 1}, "describe": {"setting": 1}}
+    assert run_all(settings) and exported == ["describe"]
+    # the modifiers are run for the modules with entry tasks that depend on them through other modules
+    assert run_all(settings | {"index": {"setting": 1}}) and sorted(exported) == ["converter", "index"]
+    assert tasks == [1, 1]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_single_pass(tmp_path, monkeypatch, workers):
+    (tmp_path / "source").mkdir()
+    entries = [{"word": f"w{i}\u200b", "n": i, "tags": ["a", "b"][: i % 3]} for i in range(2500)]
+    (tmp_path / "source" / "data.jsonl").write_text("".join(json.dumps(entry) + "\n" for entry in entries))
+
+    def run_jsonl(single_pass: bool) -> bytes:
+        config = PipelineConfig.model_validate(
+            {
+                "resource_id": "test",
+                "export": {},
+                "fields": [],
+                "workdir": tmp_path,
+                "schema": {"single_pass": single_pass, "workers": workers},
+            }
+        )
+        run(config, "jsonl", force=True)
+        # the spool is removed when replayed
+        assert not list((tmp_path / "output" / "schema").glob("*.spool"))
+        return (tmp_path / "output" / "test.jsonl").read_bytes()
+
+    two_pass = run_jsonl(False)
+    assert [json.loads(line)["n"] for line in two_pass.splitlines()] == list(range(2500))
+    # in single pass mode, the export pass replays the spooled entries instead of reading the source again
+    monkeypatch.setattr("karppipeline.modules.schema.read_data", None)
+    monkeypatch.setattr("karppipeline.run.read_data", None)
+    assert run_jsonl(True) == two_pass
@@ -0,0 +1,77 @@
+import email.message
+from urllib.error import HTTPError, URLError
+
+import pytest
+
+import karppipeline.modules.sbxmetadata as sbxmetadata
+from karppipeline.modules.sbxmetadata.models import SbxMetadataConfig
+
+
+class _Response:
+    def __init__(self, body: str, etag: str):
+        self.body = body
+        self.headers = email.message.Message()
+        self.headers["ETag"] = etag
+
+    def read(self):
+        return self.body.encode()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+@pytest.fixture
+def api(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(sbxmetadata, "RETRY_DELAY", 0)
+    requests = []
+    responses = []
+
+    def urlopen(req, timeout):
+        requests.append(dict(req.header_items()))
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(sbxmetadata.urllib.request, "urlopen", urlopen)
+    return requests, responses
+
+
+def test_cache(api):
+    requests, responses = api
+    responses.append(_Response("{}", '"v1"'))
+    assert sbxmetadata._fetch_body("test", SbxMetadataConfig()) == "{}"
+    # within the TTL, and offline, the cache is used
+    assert sbxmetadata._fetch_body("test", SbxMetadataConfig()) == "{}"
+    assert sbxmetadata._fetch_body("test", SbxMetadataConfig(offline=True)) == "{}"
+    assert len(requests) == 1
+
+    # after the TTL, the cached response is revalidated
+    responses.append(HTTPError("", 304, "Not Modified", email.message.Message(), None))
+    assert sbxmetadata._fetch_body("test", SbxMetadataConfig(cache_ttl=0)) == "{}"
+    assert requests[-1]["If-none-match"] == '"v1"'
+
+    # the cached response is used if the API can't be reached
+    responses.extend([URLError("down"), HTTPError("", 503, "Unavailable", email.message.Message(), None)])
+    assert sbxmetadata._fetch_body("test", SbxMetadataConfig(cache_ttl=0, retries=1)) == "{}"
+    assert not responses
+
+    responses.extend([URLError("down"), _Response('{"id": 1}', '"v2"')])
+    assert sbxmetadata._fetch_body("test", SbxMetadataConfig(cache_ttl=0)) == '{"id": 1}'
+    assert sbxmetadata._fetch_body("test", SbxMetadataConfig()) == '{"id": 1}'
+
+
+def test_not_cached(api):
+    _, responses = api
+    with pytest.raises(RuntimeError, match="offline"):
+        sbxmetadata._fetch_body("test", SbxMetadataConfig(offline=True))
+    responses.extend([URLError("down")] * 2)
+    with pytest.raises(RuntimeError, match="not reachable"):
+        sbxmetadata._fetch_body("test", SbxMetadataConfig(retries=1))
+    responses.append(HTTPError("", 404, "Not Found", email.message.Message(), None))
+    with pytest.raises(RuntimeError, match="Error when calling"):
+        sbxmetadata._fetch_body("test", SbxMetadataConfig())
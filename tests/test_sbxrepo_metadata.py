@@ -0,0 +1,46 @@
+import io
+
+import pytest
+
+from karppipeline.modules.sbxrepo import metadata
+from karppipeline.util import json
+
+_schema = {
+    "type": "object",
+    "properties": {"type": {"const": "lexicon"}, "size": {"type": "object"}},
+    "required": ["name"],
+}
+
+
+@pytest.fixture
+def downloads(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    metadata._get_schema_checksum.cache_clear()
+    urls = []
+
+    def urlopen(url, timeout):
+        urls.append(url)
+        return io.BytesIO(json.dumps(_schema).encode())
+
+    monkeypatch.setattr(metadata.urllib.request, "urlopen", urlopen)
+    yield urls
+    metadata._get_schema_checksum.cache_clear()
+
+
+def test_validate(downloads):
+    url = "https://example.com/schema.json"
+    metadata._validate(url, {"name": "x", "type": "lexicon"})
+    with pytest.raises(ImportError) as exc_info:
+        metadata._validate(url, {"type": "dictionary", "size": 1})
+    assert sorted(exc_info.value.args[0].splitlines()[1:]) == [
+        ': "name" is a required property',
+        'size: 1 is not of type "object"',
+        'type: "lexicon" was expected',
+    ]
+    assert downloads == [url]
+
+    # a new process uses the schema cached on disk, and gets the same compiled validator for the same content
+    metadata._get_schema_checksum.cache_clear()
+    checksum = metadata._get_schema_checksum(url)
+    assert downloads == [url]
+    assert metadata._get_validator(checksum) is metadata._get_validator(metadata._get_schema_checksum(url))
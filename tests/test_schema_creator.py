@@ -0,0 +1,140 @@
+import pytest
+
+from karppipeline import read
+from karppipeline.common import ImportException, Map
+from karppipeline.models import PipelineConfig
+from karppipeline.modules.schema.schema_creator import (
+    _create_fields,
+    _merge_schemas,
+    get_unspooled_range,
+    pre_import_resource,
+)
+from karppipeline.util import json, spool
+
+entries: list[Map] = [
+    {"word": "a", "freq": 1.5, "tags": ["x"]},
+    {"word": "bb", "freq": 2, "senses": [{"def": "d", "n": 1}]},
+    {"word": "ccc", "tags": [], "senses": [{"def": "longer", "ex": "e"}]},
+    {"word": "d", "tags": ["yyyy", "z"], "other": None},
+    {"word": "e", "other": 3},
+]
+
+
+def _list_keys(entries: list[Map]) -> set[str]:
+    return {key for entry in entries for key, value in entry.items() if isinstance(value, list)}
+
+
+@pytest.mark.parametrize("split", range(len(entries) + 1))
+def test_merge_same_as_sequential(split):
+    expected = _create_fields(iter(entries))
+    left, right = entries[:split], entries[split:]
+    merged = _merge_schemas(_create_fields(iter(left)), _create_fields(iter(right)), _list_keys(right))
+    assert json.dumps(merged) == json.dumps(expected)
+    assert {key: field.extra for key, field in merged.items()} == {key: field.extra for key, field in expected.items()}
+
+
+def test_merge_integer_to_float():
+    left = _create_fields(iter([{"a": 1}]))
+    right = _create_fields(iter([{"a": 1.5}]))
+    with pytest.raises(ImportException):
+        _merge_schemas(left, right)
+    assert _merge_schemas(right, left)["a"].type == "float"
+
+
+def test_merge_collection_mismatch():
+    left = _create_fields(iter([{"a": "x"}]))
+    right = [{"a": []}]
+    with pytest.raises(ImportException):
+        _merge_schemas(left, _create_fields(iter(right)), _list_keys(right))
+
+
+def test_first_collection_checks_all_values():
+    schema = _create_fields(iter([{"a": ["long value", "x"]}]))
+    assert schema["a"].length == 10
+    with pytest.raises(ImportException):
+        _create_fields(iter([{"a": ["x", 1]}]))
+
+
+def _write_resource(tmp_path, lines: list[Map]) -> PipelineConfig:
+    (tmp_path / "source").mkdir()
+    with open(tmp_path / "source" / "data.jsonl", "w") as fp:
+        for line in lines:
+            fp.write(json.dumps(line) + "\n")
+    return PipelineConfig.model_validate({"resource_id": "test", "export": {}, "fields": [], "workdir": tmp_path})
+
+
+def test_parallel_same_as_sequential(tmp_path):
+    config = _write_resource(tmp_path, entries * 50)
+    sequential_schema, sequential_order, sequential_size = pre_import_resource(config)
+    schema, order, size = pre_import_resource(config, workers=3)
+    assert json.dumps(schema) == json.dumps(sequential_schema)
+    assert order == sequential_order
+    assert size == sequential_size == [250]
+
+
+def test_parallel_error_row(tmp_path):
+    # chunks starting with {"a": 1} are fine on their own, but the first value makes "a" float
+    lines = [{"a": 1.5}] + [{"a": 1}] * 200 + [{"a": "x"}] + [{"a": 1}] * 100
+    config = _write_resource(tmp_path, lines)
+    with pytest.raises(ImportException, match="row: 202"):
+        pre_import_resource(config, workers=4)
+
+
+def test_appended_same_as_full(tmp_path):
+    config = _write_resource(tmp_path, entries[:2])
+    state_path = tmp_path / "inference.pickle"
+    spool_path = tmp_path / "entries.spool"
+    pre_import_resource(config, state_path=state_path)
+    with open(tmp_path / "source" / "data.jsonl", "a") as fp:
+        for line in entries[2:]:
+            fp.write(json.dumps(line) + "\n")
+    schema, order, size = pre_import_resource(config, spool_path=spool_path, state_path=state_path)
+    expected_schema, expected_order, expected_size = pre_import_resource(config)
+    assert json.dumps(schema) == json.dumps(expected_schema)
+    assert order == expected_order
+    assert size == expected_size == [5]
+    # only the appended entries are spooled
+    assert get_unspooled_range(state_path) == (0, len(json.dumps(entries[0]) + json.dumps(entries[1])) + 2)
+    assert list(spool.read_parts(spool_path)) == entries[2:]
+
+    # an error in the appended lines has the row number in the whole file
+    with open(tmp_path / "source" / "data.jsonl", "a") as fp:
+        fp.write(json.dumps({"word": 1}) + "\n")
+    with pytest.raises(ImportException, match="row: 6"):
+        pre_import_resource(config, state_path=state_path)
+
+    # a changed line means that the whole file is read again
+    (tmp_path / "source" / "data.jsonl").write_text(json.dumps({"other": "x"}) + "\n")
+    schema, _, size = pre_import_resource(config, state_path=state_path)
+    assert list(schema) == ["other"] and size == [1]
+    assert get_unspooled_range(state_path) is None
+
+
+def test_appended_csv_column_types(tmp_path, monkeypatch):
+    (tmp_path / "source").mkdir()
+    source = tmp_path / "source" / "data.csv"
+    source.write_text("word,freq,n\na,1,\n")
+    config = PipelineConfig.model_validate(
+        {"resource_id": "test", "export": {}, "fields": [], "import": {"csv": {"infer_types": True}}}
+        | {"workdir": tmp_path}
+    )
+    state_path = tmp_path / "inference.pickle"
+    pre_import_resource(config, state_path=state_path)
+
+    # the column types are inferred over the appended lines, continuing from the saved inference
+    starts = []
+    infer_column_types = read._infer_column_types
+    monkeypatch.setattr(
+        read, "_infer_column_types", lambda *args: starts.append(args[1:2]) or infer_column_types(*args)
+    )
+    with open(source, "a") as fp:
+        fp.write("b,2,\n")
+    schema, _, size = pre_import_resource(config, state_path=state_path)
+    assert starts == [(len("word,freq,n\na,1,\n"),)]
+    assert schema["freq"].type == "integer" and size == [2]
+
+    # appended values that change the types of the earlier rows, the whole file is read again
+    with open(source, "a") as fp:
+        fp.write("c,2.5,3\n")
+    schema, _, size = pre_import_resource(config, state_path=state_path)
+    assert schema["freq"].type == "float" and schema["n"].type == "integer" and size == [3]